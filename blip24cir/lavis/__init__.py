@@ -13,7 +13,7 @@ from omegaconf import OmegaConf
 from lavis.common.registry import registry
 
 from lavis.datasets.builders import *
-from lavis.models import *
+from lavis.models import BaseModel, load_model, load_model_and_preprocess, load_preprocess, model_zoo
 from lavis.processors import *
 from lavis.tasks import *
 
@@ -12,6 +12,7 @@ class Registry:
         "task_name_mapping": {},
         "processor_name_mapping": {},
         "model_name_mapping": {},
+        "model_module_mapping": {},
         "lr_scheduler_name_mapping": {},
         "runner_name_mapping": {},
         "state": {},
@@ -108,6 +109,17 @@ class Registry:
 
         return wrap
 
+    @classmethod
+    def register_model_module(cls, name, module):
+        r"""Register the module defining model 'name', which is only imported
+        when the model class is first looked up.
+
+        Args:
+            name: Key with which the model is registered by its module.
+            module: Dotted path of the module.
+        """
+        cls.mapping["model_module_mapping"][name] = module
+
     @classmethod
     def register_processor(cls, name):
         r"""Register a processor to registry with key 'name'
@@ -234,6 +246,13 @@ class Registry:
 
     @classmethod
     def get_model_class(cls, name):
+        if (
+            name not in cls.mapping["model_name_mapping"]
+            and name in cls.mapping["model_module_mapping"]
+        ):
+            import importlib
+
+            importlib.import_module(cls.mapping["model_module_mapping"][name])
         return cls.mapping["model_name_mapping"].get(name, None)
 
     @classmethod
@@ -258,7 +277,10 @@ class Registry:
 
     @classmethod
     def list_models(cls):
-        return sorted(cls.mapping["model_name_mapping"].keys())
+        return sorted(
+            set(cls.mapping["model_name_mapping"].keys())
+            | set(cls.mapping["model_module_mapping"].keys())
+        )
 
     @classmethod
     def list_tasks(cls):
@@ -5,66 +5,118 @@
  For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
+import importlib
 import logging
 import torch
 from omegaconf import OmegaConf
 from lavis.common.registry import registry
 
 from lavis.models.base_model import BaseModel
-
-from lavis.models.albef_models.albef_classification import AlbefClassification
-from lavis.models.albef_models.albef_feature_extractor import AlbefFeatureExtractor
-from lavis.models.albef_models.albef_nlvr import AlbefNLVR
-from lavis.models.albef_models.albef_pretrain import AlbefPretrain
-from lavis.models.albef_models.albef_retrieval import AlbefRetrieval
-from lavis.models.albef_models.albef_vqa import AlbefVQA
-from lavis.models.alpro_models.alpro_qa import AlproQA
-from lavis.models.alpro_models.alpro_retrieval import AlproRetrieval
-
-from lavis.models.blip_models.blip import BlipBase
-from lavis.models.blip_models.blip_caption import BlipCaption
-from lavis.models.blip_models.blip_classification import BlipClassification
-from lavis.models.blip_models.blip_feature_extractor import BlipFeatureExtractor
-from lavis.models.blip_models.blip_cir_base import BlipCirBase
-from lavis.models.blip_models.blip_image_text_matching import BlipITM
-from lavis.models.blip_models.blip_nlvr import BlipNLVR
-from lavis.models.blip_models.blip_pretrain import BlipPretrain
-from lavis.models.blip_models.blip_retrieval import BlipRetrieval
-from lavis.models.blip_models.blip_vqa import BlipVQA
-
-from lavis.models.blip2_models.blip2 import Blip2Base
-from lavis.models.blip2_models.blip2_opt import Blip2OPT
-from lavis.models.blip2_models.blip2_t5 import Blip2T5
-from lavis.models.blip2_models.blip2_qformer import Blip2Qformer
-from lavis.models.blip2_models.blip2_image_text_matching import Blip2ITM
-
-from lavis.models.blip2_models.blip2_qformer_prompt import Blip2QformerPrompt
-from lavis.models.blip2_models.blip2_qformer_cir_cat import Blip2QformerCirCat
-from lavis.models.blip2_models.blip2_qformer_cir_align_prompt import Blip2QformerCirAlignPrompt
-from lavis.models.blip2_models.blip2_qformer_cir_cls import Blip2QformerCirCls
-from lavis.models.blip2_models.blip2_qformer_cir_slt import Blip2QformerCirSlt
-from lavis.models.blip2_models.blip2_qformer_cir_neg import Blip2QformerCirNeg
-from lavis.models.blip2_models.blip2_qformer_cir_rel import Blip2QformerCirRel
-from lavis.models.blip2_models.blip2_qformer_cir_full import Blip2QformerCirFull
-from lavis.models.blip2_models.blip2_qformer_cir_neg_rel import Blip2QformerCirNegRel
-from lavis.models.blip2_models.blip2_qformer_cir_rerank import Blip2QformerCirRerank
-from lavis.models.blip2_models.blip2_qformer_cir_z_learn_pos_align import Blip2QformerCirZLearnPosAlign
-from lavis.models.blip2_models.blip2_instruct_cir import Blip2InstructCir
-
-from lavis.models.blip2_models.blip2_t5_instruct import Blip2T5Instruct
-from lavis.models.blip2_models.blip2_vicuna_instruct import Blip2VicunaInstruct
-
-from lavis.models.pnp_vqa_models.pnp_vqa import PNPVQA
-from lavis.models.pnp_vqa_models.pnp_unifiedqav2_fid import PNPUnifiedQAv2FiD
-from lavis.models.img2prompt_models.img2prompt_vqa import Img2PromptVQA
-from lavis.models.med import XBertLMHeadDecoder
-from lavis.models.vit import VisionTransformerEncoder
-from lavis.models.clip_models.model import CLIP
-
-from lavis.models.gpt_models.gpt_dialogue import GPTDialogue
-
 from lavis.processors.base_processor import BaseProcessor
 
+# model name in the registry -> module registering it, imported on first lookup
+_MODEL_MODULES = {
+    "albef_classification": "lavis.models.albef_models.albef_classification",
+    "albef_feature_extractor": "lavis.models.albef_models.albef_feature_extractor",
+    "albef_nlvr": "lavis.models.albef_models.albef_nlvr",
+    "albef_pretrain": "lavis.models.albef_models.albef_pretrain",
+    "albef_retrieval": "lavis.models.albef_models.albef_retrieval",
+    "albef_vqa": "lavis.models.albef_models.albef_vqa",
+    "alpro_qa": "lavis.models.alpro_models.alpro_qa",
+    "alpro_retrieval": "lavis.models.alpro_models.alpro_retrieval",
+    "blip_caption": "lavis.models.blip_models.blip_caption",
+    "blip_classification": "lavis.models.blip_models.blip_classification",
+    "blip_feature_extractor": "lavis.models.blip_models.blip_feature_extractor",
+    "blip_cir_base": "lavis.models.blip_models.blip_cir_base",
+    "blip_image_text_matching": "lavis.models.blip_models.blip_image_text_matching",
+    "blip_nlvr": "lavis.models.blip_models.blip_nlvr",
+    "blip_pretrain": "lavis.models.blip_models.blip_pretrain",
+    "blip_retrieval": "lavis.models.blip_models.blip_retrieval",
+    "blip_vqa": "lavis.models.blip_models.blip_vqa",
+    "blip2_opt": "lavis.models.blip2_models.blip2_opt",
+    "blip2_t5": "lavis.models.blip2_models.blip2_t5",
+    "blip2": "lavis.models.blip2_models.blip2_qformer",
+    "blip2_feature_extractor": "lavis.models.blip2_models.blip2_qformer",
+    "blip2_image_text_matching": "lavis.models.blip2_models.blip2_image_text_matching",
+    "blip2_cir_prompt": "lavis.models.blip2_models.blip2_qformer_prompt",
+    "blip2_cir_cat": "lavis.models.blip2_models.blip2_qformer_cir_cat",
+    "blip2_cir_align_prompt": "lavis.models.blip2_models.blip2_qformer_cir_align_prompt",
+    "blip2_cir_cls": "lavis.models.blip2_models.blip2_qformer_cir_cls",
+    "blip2_cir_slt": "lavis.models.blip2_models.blip2_qformer_cir_slt",
+    "blip2_cir_neg": "lavis.models.blip2_models.blip2_qformer_cir_neg",
+    "blip2_cir_rel": "lavis.models.blip2_models.blip2_qformer_cir_rel",
+    "blip2_cir_full": "lavis.models.blip2_models.blip2_qformer_cir_full",
+    "blip2_cir_neg_rel": "lavis.models.blip2_models.blip2_qformer_cir_neg_rel",
+    "blip2_cir_rerank": "lavis.models.blip2_models.blip2_qformer_cir_rerank",
+    "blip2_cir_z_learn_pos_align": "lavis.models.blip2_models.blip2_qformer_cir_z_learn_pos_align",
+    "blip2_instruct_cir": "lavis.models.blip2_models.blip2_instruct_cir",
+    "blip2_t5_instruct": "lavis.models.blip2_models.blip2_t5_instruct",
+    "blip2_vicuna_instruct": "lavis.models.blip2_models.blip2_vicuna_instruct",
+    "pnp_vqa": "lavis.models.pnp_vqa_models.pnp_vqa",
+    "pnp_unifiedqav2_fid": "lavis.models.pnp_vqa_models.pnp_unifiedqav2_fid",
+    "img2prompt_vqa": "lavis.models.img2prompt_models.img2prompt_vqa",
+    "clip": "lavis.models.clip_models.model",
+    "clip_feature_extractor": "lavis.models.clip_models.model",
+    "gpt_dialogue": "lavis.models.gpt_models.gpt_dialogue",
+}
+
+# public class -> module defining it, imported on first attribute access
+_CLASS_MODULES = {
+    "AlbefClassification": "lavis.models.albef_models.albef_classification",
+    "AlbefFeatureExtractor": "lavis.models.albef_models.albef_feature_extractor",
+    "AlbefNLVR": "lavis.models.albef_models.albef_nlvr",
+    "AlbefPretrain": "lavis.models.albef_models.albef_pretrain",
+    "AlbefRetrieval": "lavis.models.albef_models.albef_retrieval",
+    "AlbefVQA": "lavis.models.albef_models.albef_vqa",
+    "AlproQA": "lavis.models.alpro_models.alpro_qa",
+    "AlproRetrieval": "lavis.models.alpro_models.alpro_retrieval",
+    "BlipBase": "lavis.models.blip_models.blip",
+    "BlipCaption": "lavis.models.blip_models.blip_caption",
+    "BlipClassification": "lavis.models.blip_models.blip_classification",
+    "BlipFeatureExtractor": "lavis.models.blip_models.blip_feature_extractor",
+    "BlipCirBase": "lavis.models.blip_models.blip_cir_base",
+    "BlipITM": "lavis.models.blip_models.blip_image_text_matching",
+    "BlipNLVR": "lavis.models.blip_models.blip_nlvr",
+    "BlipPretrain": "lavis.models.blip_models.blip_pretrain",
+    "BlipRetrieval": "lavis.models.blip_models.blip_retrieval",
+    "BlipVQA": "lavis.models.blip_models.blip_vqa",
+    "Blip2Base": "lavis.models.blip2_models.blip2",
+    "Blip2OPT": "lavis.models.blip2_models.blip2_opt",
+    "Blip2T5": "lavis.models.blip2_models.blip2_t5",
+    "Blip2Qformer": "lavis.models.blip2_models.blip2_qformer",
+    "Blip2ITM": "lavis.models.blip2_models.blip2_image_text_matching",
+    "Blip2QformerPrompt": "lavis.models.blip2_models.blip2_qformer_prompt",
+    "Blip2QformerCirCat": "lavis.models.blip2_models.blip2_qformer_cir_cat",
+    "Blip2QformerCirAlignPrompt": "lavis.models.blip2_models.blip2_qformer_cir_align_prompt",
+    "Blip2QformerCirCls": "lavis.models.blip2_models.blip2_qformer_cir_cls",
+    "Blip2QformerCirSlt": "lavis.models.blip2_models.blip2_qformer_cir_slt",
+    "Blip2QformerCirNeg": "lavis.models.blip2_models.blip2_qformer_cir_neg",
+    "Blip2QformerCirRel": "lavis.models.blip2_models.blip2_qformer_cir_rel",
+    "Blip2QformerCirFull": "lavis.models.blip2_models.blip2_qformer_cir_full",
+    "Blip2QformerCirNegRel": "lavis.models.blip2_models.blip2_qformer_cir_neg_rel",
+    "Blip2QformerCirRerank": "lavis.models.blip2_models.blip2_qformer_cir_rerank",
+    "Blip2QformerCirZLearnPosAlign": "lavis.models.blip2_models.blip2_qformer_cir_z_learn_pos_align",
+    "Blip2InstructCir": "lavis.models.blip2_models.blip2_instruct_cir",
+    "Blip2T5Instruct": "lavis.models.blip2_models.blip2_t5_instruct",
+    "Blip2VicunaInstruct": "lavis.models.blip2_models.blip2_vicuna_instruct",
+    "PNPVQA": "lavis.models.pnp_vqa_models.pnp_vqa",
+    "PNPUnifiedQAv2FiD": "lavis.models.pnp_vqa_models.pnp_unifiedqav2_fid",
+    "Img2PromptVQA": "lavis.models.img2prompt_models.img2prompt_vqa",
+    "XBertLMHeadDecoder": "lavis.models.med",
+    "VisionTransformerEncoder": "lavis.models.vit",
+    "CLIP": "lavis.models.clip_models.model",
+    "GPTDialogue": "lavis.models.gpt_models.gpt_dialogue",
+}
+
+for _name, _module in _MODEL_MODULES.items():
+    registry.register_model_module(_name, _module)
+
+
+def __getattr__(name):
+    if name in _CLASS_MODULES:
+        return getattr(importlib.import_module(_CLASS_MODULES[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 __all__ = [
     "load_model",
     "AlbefClassification",
@@ -260,10 +312,17 @@ class ModelZoo:
     """
 
     def __init__(self) -> None:
-        self.model_zoo = {
-            k: list(v.PRETRAINED_MODEL_CONFIG_DICT.keys())
-            for k, v in registry.mapping["model_name_mapping"].items()
-        }
+        self._model_zoo = None
+
+    @property
+    def model_zoo(self):
+        # listing the types needs every model class, so the model modules are only imported here
+        if self._model_zoo is None:
+            self._model_zoo = {
+                k: list(registry.get_model_class(k).PRETRAINED_MODEL_CONFIG_DICT.keys())
+                for k in registry.list_models()
+            }
+        return self._model_zoo
 
     def __str__(self) -> str:
         return (
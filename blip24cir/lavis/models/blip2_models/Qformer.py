@@ -151,6 +151,8 @@ class BertSelfAttention(nn.Module):
                 2 * config.max_position_embeddings - 1, self.attention_head_size
             )
         self.save_attention = False
+        # fused scaled_dot_product_attention kernels, the explicit softmax path is kept for attention maps
+        self.use_sdpa = getattr(config, "use_sdpa", hasattr(F, "scaled_dot_product_attention"))
 
     def save_attn_gradients(self, attn_gradients):
         self.attn_gradients = attn_gradients
@@ -207,6 +209,27 @@ class BertSelfAttention(nn.Module):
 
         past_key_value = (key_layer, value_layer)
 
+        if (
+            self.use_sdpa
+            and self.position_embedding_type == "absolute"
+            and not output_attentions
+            and not (is_cross_attention and self.save_attention)
+            and head_mask is None
+        ):
+            if attention_mask is not None:
+                attention_mask = attention_mask.to(query_layer.dtype)
+            context_layer = F.scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attn_mask=attention_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+            context_layer = context_layer.view(*new_context_layer_shape)
+            return (context_layer, past_key_value)
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
 
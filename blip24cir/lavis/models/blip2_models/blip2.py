@@ -27,6 +27,10 @@ from transformers import BertTokenizer
 
 
 class Blip2Base(BaseModel):
+    # "max_length" pads every caption to max_txt_len, "longest" only to the longest caption of the batch;
+    # padding is on the right so the text CLS stays right after the query tokens
+    text_padding = "max_length"
+
     @classmethod
     def init_tokenizer(cls, truncation_side="right"):
         tokenizer = BertTokenizer.from_pretrained("bert-base-uncased", truncation_side=truncation_side)
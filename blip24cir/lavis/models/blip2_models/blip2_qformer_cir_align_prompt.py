@@ -108,132 +108,82 @@ class Blip2QformerCirAlignPrompt(Blip2Base):
         self.crossentropy_criterion = nn.CrossEntropyLoss()
 
     @torch.no_grad()
-    def get_bank_feats(self, image, text, target):
-        with torch.no_grad():
-            image_embeds = self.ln_vision(self.visual_encoder(image))
-            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
-                self.device
-            )
-            # query tokens
-            query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
-            query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(
-                self.device
-            )
-            # text tokens
-            text_tokens = self.tokenizer(
-                text,
-                padding="max_length",
-                truncation=True,
-                max_length=self.max_txt_len,
-                return_tensors="pt",
-            ).to(self.device)
-            # fusion reference image and text tokens into a set of multi-modal tokens
-            attention_mask = torch.cat([query_atts, text_tokens.attention_mask], dim=1)
-            fusion_output = self.Qformer.bert(
-                text_tokens.input_ids,
-                query_embeds=query_tokens,
-                attention_mask=attention_mask,
-                encoder_hidden_states=image_embeds,
-                encoder_attention_mask=image_atts,
-                return_dict=True,
-            )
-            text_output = self.Qformer.bert(
-                text_tokens.input_ids,
-                query_embeds=fusion_output.last_hidden_state[:, : query_tokens.size(1), :],
-                attention_mask=attention_mask,
-                return_dict=True,
-            )
-            fusion_feats = self.text_proj(text_output.last_hidden_state[:, 32, :])
-
-            fusion_hidden_feats = fusion_output.last_hidden_state[:, : query_tokens.size(1), :]
-            ###============== Fusion-target Contrastive ===================###
-            # reference image feature
-            target_embeds = self.ln_vision(self.visual_encoder(target))
-            target_atts = torch.ones(target_embeds.size()[:-1], dtype=torch.long).to(
-                self.device
-            )
-            target_output = self.Qformer.bert(
-                query_embeds=query_tokens,
-                encoder_hidden_states=target_embeds,
-                encoder_attention_mask=target_atts,
-                use_cache=True,
-                return_dict=True,
-            )
-            target_feats = F.normalize(
-                self.vision_proj(target_output.last_hidden_state), dim=-1
-            )
-
-            refer_output = self.Qformer.bert(
-                query_embeds=query_tokens,
-                encoder_hidden_states=image_embeds,
-                encoder_attention_mask=image_atts,
-                use_cache=True,
-                return_dict=True,
-            )
-            refer_feats = F.normalize(
-                self.vision_proj(refer_output.last_hidden_state), dim=-1
-            )
-            return fusion_hidden_feats, target_feats, refer_feats, fusion_feats
-
-    @torch.no_grad()
-    def get_refer_bank_feats(self, image, text, target):
-        with torch.no_grad():
-            image_embeds = self.ln_vision(self.visual_encoder(image))
-            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
-                self.device
-            )
-            # query tokens
-            query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
-            query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(
-                self.device
-            )
-            # text tokens
-            text_tokens = self.tokenizer(
-                text,
-                padding="max_length",
-                truncation=True,
-                max_length=self.max_txt_len,
-                return_tensors="pt",
-            ).to(self.device)
-            # fusion reference image and text tokens into a set of multi-modal tokens
-            attention_mask = torch.cat([query_atts, text_tokens.attention_mask], dim=1)
-            fusion_output = self.Qformer.bert(
-                text_tokens.input_ids,
-                query_embeds=query_tokens,
-                attention_mask=attention_mask,
-                encoder_hidden_states=image_embeds,
-                encoder_attention_mask=image_atts,
-                return_dict=True,
-            )
-            fusion_hidden_feats = fusion_output.last_hidden_state[:, : query_tokens.size(1), :]
-            ###============== Fusion-target Contrastive ===================###
-            # reference image feature
-            target_embeds = self.ln_vision(self.visual_encoder(target))
-            target_atts = torch.ones(target_embeds.size()[:-1], dtype=torch.long).to(
-                self.device
-            )
-            target_fusion_output = self.Qformer.bert(
-                text_tokens.input_ids,
-                query_embeds=query_tokens,
-                attention_mask=attention_mask,
-                encoder_hidden_states=target_embeds,
-                encoder_attention_mask=target_atts,
-                return_dict=True,
-            )
-            target_fusion_hidden_feats = target_fusion_output.last_hidden_state[:, : query_tokens.size(1), :]
-            return fusion_hidden_feats, target_fusion_hidden_feats
-
-    def forward_stage2(self, text, target_feats, fusion_hidden_states, target_indexs):
-        bs = target_indexs.shape[0]
+    def get_bank_feats(self, images, text, refer_idx, target_idx):
+        """
+        All stage-2 bank features of a batch of triplets from a single ViT pass over its unique images
+        :param images: the unique reference and target images of the batch
+        :param text: captions of the triplets
+        :param refer_idx: position in images of the reference image of every triplet
+        :param target_idx: position in images of the target image of every triplet
+        :return: fusion_hidden_feats (reference image + text, per triplet), fusion_feats (per triplet),
+            target_fusion_hidden_feats (target image + text, per triplet) and image_feats (per unique image)
+        """
+        image_embeds = self.ln_vision(self.visual_encoder(images))
+        bs = len(refer_idx)
+        # reference and target fusion share the text and run as one 2 * bs Q-Former batch
+        fusion_embeds = image_embeds[torch.cat([refer_idx, target_idx])]
+        fusion_atts = torch.ones(fusion_embeds.size()[:-1], dtype=torch.long).to(
+            self.device
+        )
         # query tokens
-        query_tokens = self.query_tokens.expand(bs, -1, -1)
+        query_tokens = self.query_tokens.expand(2 * bs, -1, -1)
         query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(
             self.device
         )
         # text tokens
+        text_tokens = self.tokenizer(
+            text + text,
+            padding=self.text_padding,
+            truncation=True,
+            max_length=self.max_txt_len,
+            return_tensors="pt",
+        ).to(self.device)
+        # fusion reference/target image and text tokens into a set of multi-modal tokens
+        attention_mask = torch.cat([query_atts, text_tokens.attention_mask], dim=1)
+        fusion_output = self.Qformer.bert(
+            text_tokens.input_ids,
+            query_embeds=query_tokens,
+            attention_mask=attention_mask,
+            encoder_hidden_states=fusion_embeds,
+            encoder_attention_mask=fusion_atts,
+            return_dict=True,
+        )
+        fusion_hidden_feats = fusion_output.last_hidden_state[:bs, : query_tokens.size(1), :]
+        target_fusion_hidden_feats = fusion_output.last_hidden_state[bs:, : query_tokens.size(1), :]
+        text_output = self.Qformer.bert(
+            text_tokens.input_ids[:bs],
+            query_embeds=fusion_hidden_feats,
+            attention_mask=attention_mask[:bs],
+            return_dict=True,
+        )
+        fusion_feats = self.text_proj(text_output.last_hidden_state[:, 32, :])
+
+        # image features of every unique image, used as target features
+        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
+            self.device
+        )
+        image_output = self.Qformer.bert(
+            query_embeds=self.query_tokens.expand(image_embeds.shape[0], -1, -1),
+            encoder_hidden_states=image_embeds,
+            encoder_attention_mask=image_atts,
+            return_dict=True,
+        )
+        image_feats = F.normalize(
+            self.vision_proj(image_output.last_hidden_state), dim=-1
+        )
+        return fusion_hidden_feats, fusion_feats, target_fusion_hidden_feats, image_feats
+
+    def stage2_query_feats(self, text, fusion_hidden_states):
+        """
+        Normalized query features of stage 2 from the fused reference tokens of the bank and the modification text
+        """
+        query_atts = torch.ones(fusion_hidden_states.size()[:-1], dtype=torch.long).to(
+            self.device
+        )
+        # text tokens
         text_tokens = self.tokenizer(
             text,
-            padding="max_length",
+            padding=self.text_padding,
             truncation=True,
             max_length=self.max_txt_len,
             return_tensors="pt",
@@ -251,18 +201,32 @@ class Blip2QformerCirAlignPrompt(Blip2Base):
         fusion_feats = F.normalize(
             self.text_proj_q(text_output.last_hidden_state[:, 32, :]), dim=-1
         )  # 128*256
-        loss_qtc = torch.tensor(0, device=self.device, dtype=torch.float)
+        return fusion_feats
+
+    @staticmethod
+    def query_target_sim(fusion_feats, target_feats, chunk_size=4096):
+        """
+        Similarity of every fusion feature with every target, max over the query tokens of the target
+        :param fusion_feats: B x D
+        :param target_feats: M x num_query_token x D
+        :param chunk_size: number of targets scored per GEMM, bounds the B x chunk_size x num_query_token buffer
+        :return: B x M
+        """
+        sims = []
+        for target_chunk in target_feats.split(chunk_size):
+            sim = fusion_feats @ target_chunk.reshape(-1, target_chunk.size(-1)).T
+            sims.append(sim.view(fusion_feats.size(0), target_chunk.size(0), -1).max(-1)[0])
+        return torch.cat(sims, dim=1)
+
+    def forward_stage2(self, text, target_feats, fusion_hidden_states, target_indexs, sim_fn=None):
+        """
+        :param sim_fn: sim_fn(fusion_feats, target_feats) -> B x M, query_target_sim by default, lets the caller score
+            a target bank kept in a reduced storage precision
+        """
+        fusion_feats = self.stage2_query_feats(text, fusion_hidden_states)
         target_indexs = target_indexs.to(self.device)
-        for i in range(bs):
-            sim_t2q_ = torch.matmul(
-                fusion_feats[i:i + 1].unsqueeze(1).unsqueeze(1), target_feats.permute(0, 2, 1)
-            ).squeeze()  # 1*128*32
-            sim_q2t, _ = sim_t2q_.max(-1)
-            ground_truth_i = target_indexs[i]
-            sim_q2t = sim_q2t / self.temp
-            loss_qtc_i = F.cross_entropy(sim_q2t, ground_truth_i)
-            loss_qtc += loss_qtc_i
-        loss_qtc /= bs
+        sim_q2t = (sim_fn or self.query_target_sim)(fusion_feats, target_feats) / self.temp
+        loss_qtc = F.cross_entropy(sim_q2t, target_indexs)
         return {
             'loss_qtc': loss_qtc,
         }
@@ -280,7 +244,7 @@ class Blip2QformerCirAlignPrompt(Blip2Base):
         # text tokens
         text_tokens = self.tokenizer(
             text,
-            padding="max_length",
+            padding=self.text_padding,
             truncation=True,
             max_length=self.max_txt_len,
             return_tensors="pt",
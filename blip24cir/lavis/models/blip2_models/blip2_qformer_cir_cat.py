@@ -106,7 +106,7 @@ class Blip2QformerCirCat(Blip2Base):
         # text tokens
         text_tokens = self.tokenizer(
             text,
-            padding="max_length",
+            padding=self.text_padding,
             truncation=True,
             max_length=self.max_txt_len,
             return_tensors="pt",
@@ -293,7 +293,7 @@ class Blip2QformerCirCat(Blip2Base):
         # text tokens
         text_tokens = self.tokenizer(
             text,
-            padding="max_length",
+            padding=self.text_padding,
             truncation=True,
             max_length=self.max_txt_len,
             return_tensors="pt",
@@ -352,7 +352,7 @@ class Blip2QformerCirCat(Blip2Base):
 
         text_tokens = self.tokenizer(
             text,
-            padding="max_length",
+            padding=self.text_padding,
             truncation=True,
             max_length=self.max_txt_len,
             return_tensors="pt",
@@ -449,7 +449,7 @@ class Blip2QformerCirCat(Blip2Base):
         # text tokens
         text_tokens = self.tokenizer(
             text,
-            padding="max_length",
+            padding=self.text_padding,
             truncation=True,
             max_length=self.max_txt_len,
             return_tensors="pt",
@@ -108,7 +108,7 @@ class Blip2QformerCirCls(Blip2Base):
         # text tokens
         text_tokens = self.tokenizer(
             text,
-            padding="max_length",
+            padding=self.text_padding,
             truncation=True,
             max_length=self.max_txt_len,
             return_tensors="pt",
@@ -196,8 +196,8 @@ class Blip2QformerCirCls(Blip2Base):
                 text_ids_neg.append(text_tokens.input_ids[neg_idx])
                 text_atts_neg.append(text_tokens.attention_mask[neg_idx])
             label_index = torch.stack(label_index, dim=0)
-            text_ids_neg = torch.stack(text_ids_neg, dim=0).view(-1, 32)
-            text_atts_neg = torch.stack(text_atts_neg, dim=0).view(-1, 32)
+            text_ids_neg = torch.stack(text_ids_neg, dim=0).view(-1, text_tokens.input_ids.size(1))
+            text_atts_neg = torch.stack(text_atts_neg, dim=0).view(-1, text_tokens.attention_mask.size(1))
         
             image_embeds_all = repeat(image_embeds, 'b t d -> (b k) t d', k=5)
             query_tokens = self.query_tokens.expand(image_embeds_all.shape[0], -1, -1)
@@ -354,7 +354,7 @@ class Blip2QformerCirCls(Blip2Base):
         # text tokens
         text_tokens = self.tokenizer(
             text,
-            padding="max_length",
+            padding=self.text_padding,
             truncation=True,
             max_length=self.max_txt_len,
             return_tensors="pt",
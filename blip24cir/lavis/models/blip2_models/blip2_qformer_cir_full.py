@@ -111,7 +111,7 @@ class Blip2QformerCirFull(Blip2Base):
         # text tokens
         text_tokens = self.tokenizer(
             text,
-            padding="max_length",
+            padding=self.text_padding,
             truncation=True,
             max_length=self.max_txt_len,
             return_tensors="pt",
@@ -400,7 +400,7 @@ class Blip2QformerCirFull(Blip2Base):
         # text tokens
         text_tokens = self.tokenizer(
             text,
-            padding="max_length",
+            padding=self.text_padding,
             truncation=True,
             max_length=self.max_txt_len,
             return_tensors="pt",
@@ -106,7 +106,7 @@ class Blip2QformerCirNeg(Blip2Base):
         # text tokens
         text_tokens = self.tokenizer(
             text,
-            padding="max_length",
+            padding=self.text_padding,
             truncation=True,
             max_length=self.max_txt_len,
             return_tensors="pt",
@@ -266,7 +266,7 @@ class Blip2QformerCirNeg(Blip2Base):
         # text tokens
         text_tokens = self.tokenizer(
             text,
-            padding="max_length",
+            padding=self.text_padding,
             truncation=True,
             max_length=self.max_txt_len,
             return_tensors="pt",
@@ -440,7 +440,7 @@ class Blip2QformerCirNeg(Blip2Base):
         # text tokens
         text_tokens = self.tokenizer(
             text,
-            padding="max_length",
+            padding=self.text_padding,
             truncation=True,
             max_length=self.max_txt_len,
             return_tensors="pt",
@@ -488,7 +488,7 @@ class Blip2QformerCirNeg(Blip2Base):
 
         text_tokens = self.tokenizer(
             text,
-            padding="max_length",
+            padding=self.text_padding,
             truncation=True,
             max_length=self.max_txt_len,
             return_tensors="pt",
@@ -7,14 +7,15 @@ from tqdm import tqdm
 
 import torch.nn.functional as F
 from data_utils import targetpad_transform, CIRDataset
-from utils import collate_fn
+from utils import collate_fn, quantize_bank, dequantize_bank, bank_similarity, load_checkpoint, \
+    base_checkpoint_record, check_base_checkpoint
 from lavis.models import load_model_and_preprocess
 
 
 class CIRPlus(nn.Module):
     def __init__(self, blip_model_name, tau=0.07,
                  transform="targetpad", target_ratio=1.25,
-                 device=torch.device('cuda'), plus=False):
+                 device=torch.device('cuda'), plus=False, text_padding="max_length"):
         super().__init__()
 
         # initial main model
@@ -25,6 +26,7 @@ class CIRPlus(nn.Module):
         update_method = getattr(self.blip_model, '_update_f_former', None)
         if callable(update_method):
             self.blip_model._update_f_former()
+        self.blip_model.text_padding = text_padding
         self.input_dim = 224
         self.device = device
         print("image size:", self.input_dim)
@@ -36,7 +38,13 @@ class CIRPlus(nn.Module):
 
     def load_ckpt(self, model_path, is_origin=False):
         print('Trying to load the model')
-        saved_state_dict = torch.load(model_path, map_location=self.device)
+        saved_state_dict = load_checkpoint(model_path)
+        base_ckpt = saved_state_dict.get('base_ckpt')
+        if base_ckpt is not None:
+            # trainable-only checkpoint (see utils.save_model), the frozen weights come from its base checkpoint
+            check_base_checkpoint(base_ckpt)
+            self.load_ckpt(base_ckpt['model_path'], base_ckpt['is_origin'])
+        self.base_ckpt = base_checkpoint_record(model_path, is_origin)
         if is_origin:
             self.blip_model.load_state_dict(saved_state_dict["Blip2QformerCirAlignPrompt"], strict=False)
             self.blip_model.init_stage2(self.tau)
@@ -46,83 +54,90 @@ class CIRPlus(nn.Module):
             self.load_state_dict(saved_state_dict['state_dict'], strict=False)
         print('model loaded successfully')
 
-    def extract_bank_features(self, cirDataset: CIRDataset, device, bank_path, reload_bank=False):
-        if not os.path.exists(bank_path) or reload_bank:
-            self.refer_bank = None
-            self.target_bank = torch.zeros((cirDataset.image_id, 32, 256), dtype=torch.float, device=self.device)
-            data_loader = DataLoader(dataset=cirDataset, batch_size=32, num_workers=multiprocessing.cpu_count(),
-                                     pin_memory=True, collate_fn=collate_fn)
-            self.query_bank = None
-            self.blip_model.eval().float()
-            for reference_image, captions, target_image, index, \
-                target_index, reference_index_all, target_index_all in tqdm(
-                data_loader, desc='encoding bank features...'):
-                reference_image = reference_image.to(device, non_blocking=True)
-                target_image = target_image.to(device, non_blocking=True)
-                text = [self.txt_processors["eval"](caption) for caption in captions]
-                refer_hidden_states, target_feats, refer_feats, fusion_feats = self.blip_model.get_bank_feats(
-                    reference_image, text,
-                    target_image)
-                refer_hidden_states = refer_hidden_states
-                target_feats = target_feats
-                refer_feats = refer_feats
-                fusion_feats = fusion_feats
-                if self.refer_bank is None:
-                    self.refer_bank = refer_hidden_states
-                    self.query_bank = fusion_feats
-                else:
-                    self.refer_bank = torch.cat((self.refer_bank, refer_hidden_states))
-                    self.query_bank = torch.cat((self.query_bank, fusion_feats))
-                self.target_bank[target_index_all] = target_feats
-                self.target_bank[reference_index_all] = refer_feats
-            self.refer_bank = self.refer_bank.detach().cpu()
-            self.target_bank = self.target_bank.detach().cpu()
-            self.query_bank = self.query_bank.detach().cpu()
-            torch.save([self.refer_bank, self.target_bank, self.query_bank], bank_path)
-        else:
+    def extract_bank_features(self, cirDataset: CIRDataset, device, bank_path, reload_bank=False,
+                              refer_bank_path=None):
+        """
+        Compute or load the stage-2 banks: reference hidden states (refer_bank) and fusion features (query_bank) per
+        triplet, target features per image (target_bank) and, if refer_bank_path is given, the per image reference
+        hidden states used with additional data (see load_refer_bank). All of them come from one pass over the
+        training triplets that runs the ViT once per unique image of every batch
+        """
+        build_refer_bank = refer_bank_path is not None and (not os.path.exists(refer_bank_path) or reload_bank)
+        if os.path.exists(bank_path) and not reload_bank and not build_refer_bank:
             items = torch.load(bank_path)
             if len(items) == 2:
                 self.refer_bank, self.target_bank = items
                 self.query_bank = None
             elif len(items) == 3:
                 self.refer_bank, self.target_bank, self.query_bank = items
+            print("load bank successfully")
+            return
+        self.refer_bank = torch.zeros((len(cirDataset), 32, 768), dtype=torch.float)
+        self.query_bank = torch.zeros((len(cirDataset), 256), dtype=torch.float)
+        self.target_bank = torch.zeros((cirDataset.image_id, 32, 256), dtype=torch.float)
+        image_refer_bank = None
+        if refer_bank_path is not None:
+            image_refer_bank = torch.zeros((cirDataset.image_id, 32, 768), dtype=torch.float)
+        data_loader = DataLoader(dataset=cirDataset, batch_size=32, num_workers=multiprocessing.cpu_count(),
+                                 pin_memory=True, collate_fn=collate_fn)
+        self.blip_model.eval().float()
+        for reference_image, captions, target_image, index, \
+            target_index, reference_index_all, target_index_all in tqdm(
+            data_loader, desc='encoding bank features...'):
+            # encode every image of the batch once, whether it is a reference or a target
+            bs = len(index)
+            image_ids, image_pos = torch.unique(torch.cat([reference_index_all, target_index_all]),
+                                                return_inverse=True)
+            first_pos = torch.zeros(len(image_ids), dtype=torch.long).scatter_(0, image_pos, torch.arange(2 * bs))
+            images = torch.cat([reference_image, target_image])[first_pos].to(device, non_blocking=True)
+            text = [self.txt_processors["eval"](caption) for caption in captions]
+            refer_hidden_states, fusion_feats, target_hidden_states, image_feats = self.blip_model.get_bank_feats(
+                images, text, image_pos[:bs].to(device), image_pos[bs:].to(device))
+            refer_hidden_states = refer_hidden_states.cpu()
+            self.refer_bank[index] = refer_hidden_states
+            self.query_bank[index] = fusion_feats.cpu()
+            self.target_bank[image_ids] = image_feats.cpu()
+            if image_refer_bank is not None:
+                image_refer_bank[reference_index_all] = refer_hidden_states
+                image_refer_bank[target_index_all] = target_hidden_states.cpu()
+        torch.save([self.refer_bank, self.target_bank, self.query_bank], bank_path)
+        if image_refer_bank is not None:
+            torch.save(image_refer_bank, refer_bank_path)
         print("load bank successfully")
 
-    def extract_refer_bank_features(self, cirDataset: CIRDataset, device, bank_path, reload_bank=False):
-        if not os.path.exists(bank_path) or reload_bank:
-            self.refer_bank = torch.zeros((cirDataset.image_id, 32, 768), dtype=torch.float, device=self.device)
-            data_loader = DataLoader(dataset=cirDataset, batch_size=32, num_workers=multiprocessing.cpu_count(),
-                                     pin_memory=True, collate_fn=collate_fn)
-            self.query_bank = None
-            self.blip_model.eval().float()
-            for reference_image, captions, target_image, index, \
-                target_index, reference_index_all, target_index_all in tqdm(
-                data_loader, desc='encoding bank features...'):
-                reference_image = reference_image.to(device, non_blocking=True)
-                target_image = target_image.to(device, non_blocking=True)
-                text = [self.txt_processors["eval"](caption) for caption in captions]
-                refer_hidden_states, target_hidden_states = self.blip_model.get_refer_bank_feats(
-                    reference_image, text,
-                    target_image)
-                self.refer_bank[reference_index_all] = refer_hidden_states
-                self.refer_bank[target_index_all] = target_hidden_states
-            self.refer_bank = self.refer_bank.detach().cpu()
-            torch.save(self.refer_bank, bank_path)
-
     def load_refer_bank(self, bank_path):
         self.refer_bank = torch.load(bank_path)
         print("load reference bank successfully")
 
+    def quantize_banks(self, precision='fp32'):
+        """
+        Keep the feature banks in a reduced storage precision, 'int8' only applies to the target bank
+        """
+        self.refer_bank = quantize_bank(self.refer_bank, 'fp16' if precision == 'int8' else precision)
+        self.target_bank = quantize_bank(self.target_bank, precision)
+
+    def bank_hidden_states(self, indexs, refer_indexs=None):
+        if self.plus:
+            return dequantize_bank(self.refer_bank[refer_indexs], self.device)
+        return dequantize_bank(self.refer_bank[indexs], self.device)
+
+    @torch.no_grad()
+    def bank_scores(self, text, indexs, refer_indexs=None):
+        text = [self.txt_processors["eval"](caption) for caption in text]
+        fusion_feats = self.blip_model.stage2_query_feats(text, self.bank_hidden_states(indexs, refer_indexs))
+        return self.bank_target_sim(fusion_feats, self.target_bank)
+
+    def bank_target_sim(self, fusion_feats, target_bank):
+        # the target bank is scored chunk by chunk in its storage precision (see utils.bank_similarity)
+        return bank_similarity(fusion_feats, target_bank, self.blip_model.query_target_sim)
+
     def forward(self, text, indexs, target_indexs, refer_indexs):
         self.blip_model.train()
         text = [self.txt_processors["eval"](caption) for caption in text]
-        target_feats = self.target_bank.detach().to(self.device)
-        if self.plus:
-            fusion_hidden_states = self.refer_bank.detach()[refer_indexs].to(self.device)
-        else:
-            fusion_hidden_states = self.refer_bank.detach()[indexs].to(self.device)
+        fusion_hidden_states = self.bank_hidden_states(indexs, refer_indexs)
         target_indexs = target_indexs.to(self.device)
-        return self.blip_model.forward_stage2(text, target_feats, fusion_hidden_states, target_indexs)
+        return self.blip_model.forward_stage2(text, self.target_bank, fusion_hidden_states, target_indexs,
+                                              sim_fn=self.bank_target_sim)
 
     def infonce_loss(self, query_features, target_features, labels=None, tau=0.01):
         logits = (query_features @ target_features.T) / tau
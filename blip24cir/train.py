@@ -16,7 +16,8 @@ from tqdm import tqdm
 
 from data_utils import CIRDataset
 from models import CIRPlus
-from utils import collate_fn, extract_index_features, save_model, RunningAverage
+from utils import collate_fn, extract_index_features, save_model, RunningAverage, set_bank_precision, \
+    BANK_PRECISIONS, AsyncValidator
 from validate import compute_cirr_val_metrics, compute_fiq_val_metrics
 
 base_path = Path(__file__).absolute().parents[1].absolute()
@@ -37,7 +38,7 @@ def main():
     print("training_path:", training_path)
 
     model = CIRPlus(args.blip_model_name, tau=args.tau, transform=args.transform,
-                    device=device, plus=args.plus)
+                    device=device, plus=args.plus, text_padding=args.text_padding)
     if args.model_path:
         model.load_ckpt(args.model_path, True)
     preprocess = model.preprocess
@@ -81,18 +82,84 @@ def main():
     scaler = torch.cuda.amp.GradScaler()
 
     best_score = 0
-    cur_score = 0
     loss_avg = RunningAverage()
     if not args.bank_path:
         bank_path = os.path.join(args.output_path, f"{args.dataset}_bank.pth")
     else:
         bank_path = args.bank_path
-    model.extract_bank_features(relative_train_dataset, device, bank_path, args.reload_bank)
+    # the bank of the additional data is computed in the same pass
     refer_bank_path = bank_path.replace("bank", "refer_bank")
-    model.extract_refer_bank_features(relative_train_dataset, device, refer_bank_path, args.reload_bank)
+    model.extract_bank_features(relative_train_dataset, device, bank_path, args.reload_bank, refer_bank_path)
     if args.plus:
         model.load_refer_bank(refer_bank_path)
     relative_train_dataset.use_bank = True
+    set_bank_precision(model, args.bank_precision, relative_train_loader, args.bank_recall_batches)
+
+    def validate(val_model, epoch):
+        """
+        Compute the validation metrics of val_model and save it as the best model when they improve
+        """
+        nonlocal best_score
+        val_model.blip_model.eval()
+        if args.dataset == 'cirr':
+            results = compute_cirr_val_metrics(relative_val_dataset, val_model, val_index_features,
+                                               val_index_names, device=device)
+            group_recall_at1, group_recall_at2, group_recall_at3, recall_at1, recall_at5, recall_at10, recall_at50 = results
+
+            results_dict = {
+                'group_recall_at1': group_recall_at1,
+                'group_recall_at2': group_recall_at2,
+                'group_recall_at3': group_recall_at3,
+                'recall_at1': recall_at1,
+                'recall_at5': recall_at5,
+                'recall_at10': recall_at10,
+                'recall_at50': recall_at50,
+                'recall_mean': (group_recall_at1 + recall_at5) / 2,
+                'arithmetic_mean': mean(results),
+                'harmonic_mean': harmonic_mean(results),
+                'geometric_mean': geometric_mean(results)
+            }
+            print(json.dumps(results_dict, indent=4))
+            cur_score = results_dict['recall_mean']
+            if args.nni:
+                nni.report_intermediate_result({'default': best_score, "recall_mean": results_dict['recall_mean']})
+        elif args.dataset == 'fiq':
+            recalls_at10 = []
+            recalls_at50 = []
+
+            # Compute and log validation metrics for each validation dataset (which corresponds to a different
+            # FashionIQ category)
+            for dress_relative_dataset, dress_classic_dataset, idx in zip(relative_val_datasets, classic_val_datasets,
+                                                                          idx_to_dress_mapping):
+                index_features, index_names = index_features_list[idx], index_names_list[idx]
+                recall_at10, recall_at50 = compute_fiq_val_metrics(dress_relative_dataset, val_model,
+                                                                   index_features, index_names, device=device)
+                recalls_at10.append(recall_at10)
+                recalls_at50.append(recall_at50)
+                torch.cuda.empty_cache()
+
+            results_dict = {}
+            for i in range(len(recalls_at10)):
+                results_dict[f'{idx_to_dress_mapping[i]}_recall_at10'] = recalls_at10[i]
+                results_dict[f'{idx_to_dress_mapping[i]}_recall_at50'] = recalls_at50[i]
+            results_dict.update({
+                f'average_recall_at10': mean(recalls_at10),
+                f'average_recall_at50': mean(recalls_at50),
+                f'average_recall': (mean(recalls_at50) + mean(recalls_at10)) / 2
+            })
+            cur_score = results_dict['average_recall']
+            print(json.dumps(results_dict, indent=4))
+            if args.nni:
+                nni.report_intermediate_result(
+                    {'default': best_score, "average_recall_at10": results_dict['average_recall_at10']})
+
+        if cur_score > best_score:
+            best_score = cur_score
+            print("current best:", best_score)
+            if not args.nni:
+                save_model('best', epoch, val_model, training_path, args.save_trainable_only)
+
+    validator = AsyncValidator(model, validate) if args.async_validation else None
     print('Training loop started')
     for epoch in range(args.num_epochs):
         model.blip_model.train()
@@ -120,64 +187,12 @@ def main():
         print(f"Epoch [{epoch}] Loss: {loss_avg()}")
 
         if epoch % args.validation_frequency == 0:
-            model.blip_model.eval()
-            if args.dataset == 'cirr':
-                results = compute_cirr_val_metrics(relative_val_dataset, model, val_index_features,
-                                                   val_index_names, device=device)
-                group_recall_at1, group_recall_at2, group_recall_at3, recall_at1, recall_at5, recall_at10, recall_at50 = results
-
-                results_dict = {
-                    'group_recall_at1': group_recall_at1,
-                    'group_recall_at2': group_recall_at2,
-                    'group_recall_at3': group_recall_at3,
-                    'recall_at1': recall_at1,
-                    'recall_at5': recall_at5,
-                    'recall_at10': recall_at10,
-                    'recall_at50': recall_at50,
-                    'recall_mean': (group_recall_at1 + recall_at5) / 2,
-                    'arithmetic_mean': mean(results),
-                    'harmonic_mean': harmonic_mean(results),
-                    'geometric_mean': geometric_mean(results)
-                }
-                print(json.dumps(results_dict, indent=4))
-                cur_score = results_dict['recall_mean']
-                if args.nni:
-                    nni.report_intermediate_result({'default': best_score, "recall_mean": results_dict['recall_mean']})
-            elif args.dataset == 'fiq':
-                recalls_at10 = []
-                recalls_at50 = []
-
-                # Compute and log validation metrics for each validation dataset (which corresponds to a different
-                # FashionIQ category)
-                for relative_val_dataset, classic_val_dataset, idx in zip(relative_val_datasets, classic_val_datasets,
-                                                                          idx_to_dress_mapping):
-                    index_features, index_names = index_features_list[idx], index_names_list[idx]
-                    recall_at10, recall_at50 = compute_fiq_val_metrics(relative_val_dataset, model,
-                                                                       index_features, index_names, device=device)
-                    recalls_at10.append(recall_at10)
-                    recalls_at50.append(recall_at50)
-                    torch.cuda.empty_cache()
-
-                results_dict = {}
-                for i in range(len(recalls_at10)):
-                    results_dict[f'{idx_to_dress_mapping[i]}_recall_at10'] = recalls_at10[i]
-                    results_dict[f'{idx_to_dress_mapping[i]}_recall_at50'] = recalls_at50[i]
-                results_dict.update({
-                    f'average_recall_at10': mean(recalls_at10),
-                    f'average_recall_at50': mean(recalls_at50),
-                    f'average_recall': (mean(recalls_at50) + mean(recalls_at10)) / 2
-                })
-                cur_score = results_dict['average_recall']
-                print(json.dumps(results_dict, indent=4))
-                if args.nni:
-                    nni.report_intermediate_result(
-                        {'default': best_score, "average_recall_at10": results_dict['average_recall_at10']})
-
-            if cur_score > best_score:
-                best_score = cur_score
-                print("current best:", best_score)
-                if not args.nni:
-                    save_model('best', epoch, model, training_path)
+            if validator is not None:
+                validator.submit(model, epoch)
+            else:
+                validate(model, epoch)
+    if validator is not None:
+        validator.close()
     if args.nni:
         nni.report_final_result({'default': best_score})
 
@@ -206,6 +221,16 @@ if __name__ == '__main__':
     parser.add_argument("--reload_bank", action='store_true')
     parser.add_argument("--device", default='0')
     parser.add_argument("--bank_path", default='')
+    parser.add_argument("--bank_precision", default='fp32', choices=BANK_PRECISIONS,
+                        help="storage precision of the feature banks, int8 only applies to the target bank")
+    parser.add_argument("--bank_recall_batches", type=int, default=20,
+                        help="number of training batches used to report the recall change of --bank_precision")
+    parser.add_argument("--text_padding", default='max_length', choices=['max_length', 'longest'],
+                        help='pad captions to max_txt_len or to the longest caption of the batch')
+    parser.add_argument("--save_trainable_only", action='store_true',
+                        help='only save the trainable weights and a reference to the loaded checkpoint')
+    parser.add_argument("--async_validation", action='store_true',
+                        help='validate in a background thread on a snapshot of the trainable weights')
     parser.add_argument("--nni", action='store_true')
     parser.add_argument("--plus", action='store_true', help='whether use additional data')
     parser.add_argument("--llmcap", action='store_true', help='whether use llm caption')
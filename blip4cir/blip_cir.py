@@ -79,6 +79,32 @@ class BLIP_Retrieval(nn.Module):
         image_embeds_p = F.normalize(self.vision_proj(image_embeds[:, 0, :]), dim=-1)  # B x 256
         return image_embeds_p
 
+    def img_embed_pruned(self, image, num_tokens=64, mode='topk'):
+        '''
+        Reduced token sequence of the reference image for the stage-2 bank: CLS followed by
+        'topk': the num_tokens patch tokens that receive the most CLS attention in the last ViT block (in spatial order)
+        'pool': the patch grid average pooled to sqrt(num_tokens) x sqrt(num_tokens) groups
+        '''
+        if mode == 'topk':
+            last_attn = self.visual_encoder.blocks[-1].attn
+            image_embeds = self.visual_encoder(image, register_blk=len(self.visual_encoder.blocks) - 1)
+            cls_attn = last_attn.get_attention_map()[:, :, 0, 1:].mean(dim=1)  # B x 576, averaged over heads
+            last_attn.save_attention_map(None)
+            token_idx = cls_attn.topk(num_tokens, dim=-1).indices.sort(dim=-1).values + 1
+            patch_tokens = image_embeds.gather(1, token_idx.unsqueeze(-1).expand(-1, -1, image_embeds.size(-1)))
+        elif mode == 'pool':
+            groups = int(round(num_tokens ** 0.5))
+            if groups * groups != num_tokens:
+                raise ValueError(f"'pool' needs a square number of bank tokens, got {num_tokens}")
+            image_embeds = self.visual_encoder(image)
+            B, L, C = image_embeds.shape
+            grid = int(round((L - 1) ** 0.5))
+            patch_tokens = image_embeds[:, 1:].transpose(1, 2).reshape(B, C, grid, grid)
+            patch_tokens = F.adaptive_avg_pool2d(patch_tokens, groups).flatten(2).transpose(1, 2)
+        else:
+            raise ValueError(f"unknown bank token mode {mode}")
+        return torch.cat([image_embeds[:, :1], patch_tokens], dim=1)
+
     def img_txt_fusion(self, r_image_embeds, t_image_embeds, text, train=False, return_raw=False):
         device = r_image_embeds.device
 
@@ -9,14 +9,15 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 import torch.nn.functional as F
 from data_utils import targetpad_transform, CIRDataset
-from utils import collate_fn
+from utils import collate_fn, quantize_bank, dequantize_bank, bank_similarity, load_checkpoint, \
+    base_checkpoint_record, check_base_checkpoint
 from blip_cir import blip_cir
 
 
 class CIRPlus(nn.Module):
     def __init__(self, blip_model_name, tau=0.01,
                  transform="targetpad", target_ratio=1.25, encoder='both',
-                 device=torch.device('cuda'), plus=False):
+                 device=torch.device('cuda'), plus=False, bank_tokens=0, bank_token_mode='topk'):
         super().__init__()
 
         # initial main model
@@ -34,74 +35,158 @@ class CIRPlus(nn.Module):
         if transform == 'targetpad':
             self.preprocess = targetpad_transform(target_ratio, self.input_dim)
         self.encoder = encoder
+        # reference bank keeps CLS + bank_tokens image tokens (all 577 tokens if 0), see BLIP_Retrieval.img_embed_pruned
+        self.bank_tokens = bank_tokens
+        self.bank_token_mode = bank_token_mode
+        self.bank_seq_len = bank_tokens + 1 if bank_tokens > 0 else 577
 
     def load_ckpt(self, model_path, is_origin=False):
-        saved_state_dict = torch.load(model_path, map_location=self.device)
+        saved_state_dict = load_checkpoint(model_path)
+        base_ckpt = saved_state_dict.get('base_ckpt')
+        if base_ckpt is not None:
+            # trainable-only checkpoint (see utils.save_model), the frozen weights come from its base checkpoint
+            check_base_checkpoint(base_ckpt)
+            self.load_ckpt(base_ckpt['model_path'], base_ckpt['is_origin'])
+        self.base_ckpt = base_checkpoint_record(model_path, is_origin)
         if is_origin:
             self.blip.load_state_dict(saved_state_dict["BLIP_Retrieval"], strict=False)
         else:
             self.load_state_dict(saved_state_dict['state_dict'], strict=False)
 
-    def extract_bank_features(self, cirDataset: CIRDataset, device, bank_path, reload_bank=False):
+    def refer_embed(self, image):
+        if self.bank_tokens > 0:
+            return self.blip.img_embed_pruned(image, self.bank_tokens, self.bank_token_mode)
+        return self.blip.img_embed(image)
+
+    def extract_bank_features(self, cirDataset: CIRDataset, device, bank_path, reload_bank=False,
+                              refer_bank_path=None):
+        """
+        Compute or load the reference token bank and the target bank, both keyed by image. If refer_bank_path is
+        given, the reference tokens of the target images are encoded in the same pass and the resulting bank of all
+        images, used with additional data (see load_refer_bank), is saved there
+        """
         self.blip.eval().float()
-        if not os.path.exists(bank_path) or reload_bank:
-            self.refer_bank = torch.zeros(len(cirDataset), 577, 768)
+        build_refer_bank = refer_bank_path is not None and (not os.path.exists(refer_bank_path) or reload_bank)
+        if os.path.exists(bank_path) and not reload_bank and not build_refer_bank:
+            self.refer_bank, self.target_bank = torch.load(bank_path)
+            # banks saved before the reference bank was keyed by image hold one entry per triplet
+            reload_bank = len(self.refer_bank) != cirDataset.image_id
+            if not reload_bank:
+                self.check_bank_seq_len(self.refer_bank, bank_path)
+        if not os.path.exists(bank_path) or reload_bank or build_refer_bank:
+            # many triplets share a reference image, so reference tokens are stored once per image and looked up
+            # through reference_index_all like the target bank
+            self.refer_bank = torch.zeros(cirDataset.image_id, self.bank_seq_len, 768)
             self.target_bank = torch.zeros(cirDataset.image_id, self.output_dim)
+            refer_encoded = torch.zeros(cirDataset.image_id, dtype=torch.bool)
+            target_encoded = torch.zeros(cirDataset.image_id, dtype=torch.bool)
             data_loader = DataLoader(dataset=cirDataset, batch_size=32, num_workers=multiprocessing.cpu_count(),
                                      pin_memory=True, collate_fn=collate_fn)
             for reference_image, caption, target_image, index, \
                 target_index, reference_index_all, target_index_all in tqdm(
                 data_loader, desc='encoding bank features...'):
-                reference_image = reference_image.to(device, non_blocking=True)
-                target_image = target_image.to(device, non_blocking=True)
+                # only encode the images that are not in the banks yet
+                new_refer = ~refer_encoded[reference_index_all]
+                new_target = ~target_encoded[target_index_all]
+                reference_index_all = reference_index_all[new_refer]
+                target_index_all = target_index_all[new_target]
+                reference_image = reference_image[new_refer].to(device, non_blocking=True)
+                target_image = target_image[new_target].to(device, non_blocking=True)
 
                 with torch.no_grad():
-                    batch_refer_features = self.blip.img_embed(reference_image)
-                    batch_target_features_p = self.blip.img_embed(target_image, return_pool_and_normalized=True)[
-                        -1].detach().cpu()
-                    batch_refer_features_p = F.normalize(
-                        self.blip.vision_proj(batch_refer_features[:, 0, :])).detach().cpu()
-                    batch_refer_features = batch_refer_features.detach().cpu()
-                    self.refer_bank[index] = batch_refer_features
-                    self.target_bank[reference_index_all] = batch_refer_features_p
-                    self.target_bank[target_index_all] = batch_target_features_p
+                    if len(reference_index_all) > 0:
+                        batch_refer_features = self.refer_embed(reference_image)
+                        batch_refer_features_p = F.normalize(
+                            self.blip.vision_proj(batch_refer_features[:, 0, :])).detach().cpu()
+                        batch_refer_features = batch_refer_features.detach().cpu()
+                        self.refer_bank[reference_index_all] = batch_refer_features
+                        self.target_bank[reference_index_all] = batch_refer_features_p
+                    if len(target_index_all) > 0 and refer_bank_path is not None:
+                        batch_target_features = self.refer_embed(target_image)
+                        batch_target_features_p = F.normalize(
+                            self.blip.vision_proj(batch_target_features[:, 0, :])).detach().cpu()
+                        self.refer_bank[target_index_all] = batch_target_features.detach().cpu()
+                        self.target_bank[target_index_all] = batch_target_features_p
+                    elif len(target_index_all) > 0:
+                        batch_target_features_p = self.blip.img_embed(target_image, return_pool_and_normalized=True)[
+                            -1].detach().cpu()
+                        self.target_bank[target_index_all] = batch_target_features_p
+                refer_encoded[reference_index_all] = True
+                target_encoded[reference_index_all] = True
+                target_encoded[target_index_all] = True
+                if refer_bank_path is not None:
+                    refer_encoded[target_index_all] = True
             torch.save([self.refer_bank, self.target_bank], bank_path)
-        else:
-            self.refer_bank, self.target_bank = torch.load(bank_path)
+            if refer_bank_path is not None:
+                torch.save(self.refer_bank, refer_bank_path)
         print("load bank successfully")
 
-    def extract_refer_bank_features(self, cirDataset: CIRDataset, device, bank_path, reload_bank=False):
-        self.blip.eval().float()
-        if not os.path.exists(bank_path) or reload_bank:
-            self.refer_bank = torch.zeros(cirDataset.image_id, 577, 768)
-            data_loader = DataLoader(dataset=cirDataset, batch_size=32, num_workers=multiprocessing.cpu_count(),
-                                     pin_memory=True, collate_fn=collate_fn)
-            for reference_image, caption, target_image, index, \
-                target_index, reference_index_all, target_index_all in tqdm(
-                data_loader, desc='encoding bank features...'):
-                reference_image = reference_image.to(device, non_blocking=True)
-                target_image = target_image.to(device, non_blocking=True)
-                with torch.no_grad():
-                    batch_refer_features = self.blip.img_embed(reference_image).detach().cpu()
-                    batch_target_features = self.blip.img_embed(target_image).detach().cpu()
-                    self.refer_bank[reference_index_all] = batch_refer_features
-                    self.refer_bank[target_index_all] = batch_target_features
-            torch.save(self.refer_bank, bank_path)
-        print("load reference bank successfully")
+    @torch.no_grad()
+    def report_bank_tokens(self, cirDataset: CIRDataset, device, num_batches=20, ks=(1, 10, 50)):
+        """
+        Compare the reduced-token reference bank with the full 577-token one: bank size, cross-attention length and
+        recall@k of the training queries of num_batches batches against the target bank
+        """
+        if self.bank_tokens <= 0:
+            return
+        self.blip.eval()
+        data_loader = DataLoader(dataset=cirDataset, batch_size=32, num_workers=multiprocessing.cpu_count(),
+                                 pin_memory=True, collate_fn=collate_fn)
+        hits = {'full': {k: 0 for k in ks}, 'pruned': {k: 0 for k in ks}}
+        num_queries = 0
+        for i, (reference_image, caption, target_image, index,
+                target_index, reference_index_all, target_index_all) in enumerate(data_loader):
+            if i == num_batches:
+                break
+            reference_image = reference_image.to(device, non_blocking=True)
+            labels = target_index_all.to(self.device)
+            for name, refer_feats in (('full', self.blip.img_embed(reference_image)),
+                                      ('pruned', self.refer_embed(reference_image))):
+                scores = bank_similarity(self.blip.img_txt_fusion(refer_feats, None, caption), self.target_bank)
+                ranks = (scores > scores.gather(1, labels.unsqueeze(1))).sum(dim=1)
+                for k in ks:
+                    hits[name][k] += (ranks < k).sum().item()
+            num_queries += len(labels)
+        print(f"reference bank: {self.bank_seq_len} instead of 577 tokens per image "
+              f"({577 / self.bank_seq_len:.1f}x smaller bank and cross-attention keys)")
+        for k in ks:
+            full, pruned = hits['full'][k] / num_queries * 100, hits['pruned'][k] / num_queries * 100
+            print(f"bank recall@{k}: {full:.2f} (full) -> {pruned:.2f} ({self.bank_token_mode}{self.bank_tokens}), "
+                  f"delta {pruned - full:+.2f}")
+
+    def check_bank_seq_len(self, refer_bank, bank_path):
+        # a bank built with another --bank_tokens (e.g. an explicit --bank_path) would train on a different number
+        # of reference tokens than validation uses
+        if refer_bank.shape[1] != self.bank_seq_len:
+            raise ValueError(f"reference bank {bank_path} has {refer_bank.shape[1]} tokens per image but "
+                             f"--bank_tokens {self.bank_tokens} needs {self.bank_seq_len}, "
+                             f"rebuild it with --reload_bank or use another --bank_path")
 
     def load_refer_bank(self, bank_path):
         self.refer_bank = torch.load(bank_path)
+        self.check_bank_seq_len(self.refer_bank, bank_path)
+
+    def quantize_banks(self, precision='fp32'):
+        """
+        Keep the feature banks in a reduced storage precision, 'int8' only applies to the target bank
+        """
+        self.refer_bank = quantize_bank(self.refer_bank, 'fp16' if precision == 'int8' else precision)
+        self.target_bank = quantize_bank(self.target_bank, precision)
+
+    def bank_query_features(self, text, indexs, refer_indexs=None):
+        # the reference bank is keyed by image (see extract_bank_features), with or without additional data
+        reference_image_feats = dequantize_bank(self.refer_bank[refer_indexs], self.device)
+        return self.blip.img_txt_fusion(reference_image_feats, None, text)
+
+    def bank_scores(self, text, indexs, refer_indexs=None):
+        query_feats = self.bank_query_features(text, indexs, refer_indexs)
+        return bank_similarity(query_feats, self.target_bank)
 
     def bank_large_step(self, loss, text, indexs, target_indexs,
                         refer_indexs=None):
-        if self.plus:
-            reference_image_feats = self.refer_bank[refer_indexs].detach().to(self.device)
-        else:
-            reference_image_feats = self.refer_bank[indexs].detach().to(self.device)
-        query_feats = self.blip.img_txt_fusion(reference_image_feats, None, text)
-        target_feats_all = self.target_bank.detach().to(self.device)
+        query_feats = self.bank_query_features(text, indexs, refer_indexs)
         target_indexs = target_indexs.to(self.device)
-        target_neg_loss = self.infonce_loss(query_feats, target_feats_all, target_indexs, tau=self.tau)
+        target_neg_loss = self.bank_infonce_loss(query_feats, target_indexs)
         loss['bank_loss'] = target_neg_loss
 
     def forward(self, text, indexs, target_indexs, refer_indexs, reference_image=None, target_image=None):
@@ -119,3 +204,7 @@ class CIRPlus(nn.Module):
         if labels is None:
             labels = torch.arange(query_features.shape[0]).long().to(self.device)
         return self.crossentropy_criterion(logits, labels)
+
+    def bank_infonce_loss(self, query_features, labels):
+        logits = bank_similarity(query_features, self.target_bank) / self.tau
+        return self.crossentropy_criterion(logits, labels)
@@ -1,6 +1,8 @@
 import gzip
 import html
 import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 
 import ftfy
@@ -59,29 +61,83 @@ def whitespace_clean(text):
     return text
 
 
+def parse_bpe(bpe_path):
+    """
+    Parse the gzipped BPE merges into the token encoder and the merge ranks
+    """
+    merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
+    merges = merges[1:49152 - 256 - 2 + 1]
+    merges = [tuple(merge.split()) for merge in merges]
+    vocab = list(bytes_to_unicode().values())
+    vocab = vocab + [v + '</w>' for v in vocab]
+    for merge in merges:
+        vocab.append(''.join(merge))
+    vocab.extend(['<|startoftext|>', '<|endoftext|>'])
+    encoder = dict(zip(vocab, range(len(vocab))))
+    bpe_ranks = dict(zip(merges, range(len(merges))))
+    return encoder, bpe_ranks
+
+
+def load_bpe(bpe_path):
+    """
+    Load the encoder and the merge ranks of parse_bpe from a pickle next to the gz, which is (re)built when missing
+    or older than the gz
+    :return: encoder, bpe_ranks
+    """
+    cache_path = bpe_path + '.pkl'
+    stat = os.stat(bpe_path)
+    key = (stat.st_size, stat.st_mtime_ns)
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = pickle.load(f)
+        if cache['key'] == key:
+            return cache['encoder'], cache['bpe_ranks']
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+        pass
+    encoder, bpe_ranks = parse_bpe(bpe_path)
+    try:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'key': key, 'encoder': encoder, 'bpe_ranks': bpe_ranks}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # read-only install, parse the gz again next time
+        pass
+    return encoder, bpe_ranks
+
+
 class SimpleTokenizer(object):
-    def __init__(self, bpe_path: str = default_bpe()):
+    def __init__(self, bpe_path: str = default_bpe(), cache_size: int = 2 ** 16):
+        """
+        :param cache_size: number of words whose BPE split is kept in the LRU cache, None for an unbounded cache
+        """
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
-        merges = merges[1:49152 - 256 - 2 + 1]
-        merges = [tuple(merge.split()) for merge in merges]
-        vocab = list(bytes_to_unicode().values())
-        vocab = vocab + [v + '</w>' for v in vocab]
-        for merge in merges:
-            vocab.append(''.join(merge))
-        vocab.extend(['<|startoftext|>', '<|endoftext|>'])
-        self.encoder = dict(zip(vocab, range(len(vocab))))
+        self.encoder, self.bpe_ranks = load_bpe(bpe_path)
         self.decoder = {v: k for k, v in self.encoder.items()}
-        self.bpe_ranks = dict(zip(merges, range(len(merges))))
-        self.cache = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
+        self.special_tokens = {'<|startoftext|>', '<|endoftext|>'}
+        self.cache_size = cache_size
+        self.cache = lru_cache(maxsize=cache_size)(self._bpe)
         self.pat = re.compile(
             r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""",
             re.IGNORECASE)
 
+    def __getstate__(self):
+        # the lru_cache wrapping the bound _bpe can not be pickled (e.g. when sent to spawned DataLoader workers)
+        state = self.__dict__.copy()
+        del state['cache']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = lru_cache(maxsize=self.cache_size)(self._bpe)
+
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
+        if token in self.special_tokens:
+            return token
+        return self.cache(token)
+
+    def _bpe(self, token):
         word = tuple(token[:-1]) + (token[-1] + '</w>',)
         pairs = get_pairs(word)
 
@@ -117,7 +173,6 @@ class SimpleTokenizer(object):
             else:
                 pairs = get_pairs(word)
         word = ' '.join(word)
-        self.cache[token] = word
         return word
 
     def encode(self, text):
@@ -128,6 +183,21 @@ class SimpleTokenizer(object):
             bpe_tokens.extend(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(' '))
         return bpe_tokens
 
+    def encode_batch(self, texts, num_workers=0):
+        """
+        Encode a list of texts, each distinct text only once
+        :param num_workers: number of threads encoding the distinct texts, 0 to encode them in the calling thread
+        :return: list of token lists, aligned with texts
+        """
+        unique_texts = list(dict.fromkeys(texts))
+        if num_workers > 0 and len(unique_texts) > 1:
+            with ThreadPoolExecutor(num_workers) as pool:
+                encoded = list(pool.map(self.encode, unique_texts))
+        else:
+            encoded = [self.encode(text) for text in unique_texts]
+        encoded = dict(zip(unique_texts, encoded))
+        return [encoded[text] for text in texts]
+
     def decode(self, tokens):
         text = ''.join([self.decoder[token] for token in tokens])
         text = bytearray([self.byte_decoder[c] for c in text]).decode('utf-8', errors="replace").replace('</w>', ' ')
@@ -13,7 +13,8 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 from torch.utils.checkpoint import checkpoint
 from data_utils import targetpad_transform, CIRDataset
-from utils import collate_fn
+from utils import collate_fn, quantize_bank, dequantize_bank, bank_similarity, load_checkpoint, \
+    base_checkpoint_record, check_base_checkpoint
 
 
 class CIRPlus(nn.Module):
@@ -56,7 +57,13 @@ class CIRPlus(nn.Module):
         return query_features
 
     def load_ckpt(self, model_path, is_origin=False):
-        saved_state_dict = torch.load(model_path, map_location=self.device)
+        saved_state_dict = load_checkpoint(model_path)
+        base_ckpt = saved_state_dict.get('base_ckpt')
+        if base_ckpt is not None:
+            # trainable-only checkpoint (see utils.save_model), the frozen weights come from its base checkpoint
+            check_base_checkpoint(base_ckpt)
+            self.load_ckpt(base_ckpt['model_path'], base_ckpt['is_origin'])
+        self.base_ckpt = base_checkpoint_record(model_path, is_origin)
         if is_origin:
             self.clip.load_state_dict(saved_state_dict[self.clip.__class__.__name__], strict=False)
         else:
@@ -112,35 +119,48 @@ class CIRPlus(nn.Module):
         j = random.sample(range_target, k)
         return j
 
-    def part_infonce_loss(self, query_feats, target_feats_all, target_indexs):
-        M = target_feats_all.shape[0]
+    def part_infonce_loss(self, query_feats, target_indexs):
+        M = self.target_bank.shape[0]
         N = query_feats.shape[0]
         target_loss = torch.tensor(0, device=self.device, dtype=torch.float)
         for i in range(N):
             pos_id = target_indexs[i].item()
             neg_ids = self.get_neg_id(pos_id, M, self.neg_num)
-            neg_feats = target_feats_all[neg_ids]
-            pos_feats = target_feats_all[pos_id].unsqueeze(0)
-            target_feats = torch.cat([pos_feats, neg_feats])
+            # only the positive and the sampled negatives are converted to fp32
+            target_feats = dequantize_bank(self.target_bank[[pos_id] + neg_ids], self.device)
             target_loss += self.infonce_loss(query_feats[i], target_feats,
                                              torch.tensor(0, device=self.device, dtype=torch.long), tau=self.tau)
         target_loss /= N
         return target_loss
 
-    def bank_large_step(self, loss, text_feats, indexs, target_indexs,
-                        refer_indexs=None):
+    def quantize_banks(self, precision='fp32'):
+        """
+        Keep the feature banks in a reduced storage precision, 'int8' only applies to the target bank
+        """
+        self.refer_bank = quantize_bank(self.refer_bank, 'fp16' if precision == 'int8' else precision)
+        self.target_bank = quantize_bank(self.target_bank, precision)
+
+    def bank_query_features(self, text_feats, indexs, refer_indexs=None):
         if self.plus:
-            reference_image_feats = self.refer_bank[refer_indexs].detach().to(self.device)
+            reference_image_feats = self.refer_bank[refer_indexs]
         else:
-            reference_image_feats = self.refer_bank[indexs].detach().to(self.device)
+            reference_image_feats = self.refer_bank[indexs]
+        reference_image_feats = dequantize_bank(reference_image_feats, self.device)
         query_feats = self.combining_function(reference_image_feats, text_feats)
-        query_feats = F.normalize(query_feats)
-        target_feats_all = self.target_bank.detach().to(self.device)
+        return F.normalize(query_feats)
+
+    def bank_scores(self, text, indexs, refer_indexs=None):
+        query_feats = self.bank_query_features(self.encode_text(text), indexs, refer_indexs)
+        return bank_similarity(query_feats, self.target_bank)
+
+    def bank_large_step(self, loss, text_feats, indexs, target_indexs,
+                        refer_indexs=None):
+        query_feats = self.bank_query_features(text_feats, indexs, refer_indexs)
         target_indexs = target_indexs.to(self.device)
         if self.neg_num > 0:
-            target_neg_loss = self.part_infonce_loss(query_feats, target_feats_all, target_indexs)
+            target_neg_loss = self.part_infonce_loss(query_feats, target_indexs)
         else:
-            target_neg_loss = self.infonce_loss(query_feats, target_feats_all, target_indexs, tau=self.tau)
+            target_neg_loss = self.bank_infonce_loss(query_feats, target_indexs)
         loss['bank_loss'] = target_neg_loss
 
     def forward(self, text, indexs, target_indexs, refer_indexs, refer_image=None, target_image=None):
@@ -165,3 +185,7 @@ class CIRPlus(nn.Module):
         if labels is None:
             labels = torch.arange(query_features.shape[0]).long().to(self.device)
         return self.crossentropy_criterion(logits, labels)
+
+    def bank_infonce_loss(self, query_features, labels):
+        logits = bank_similarity(query_features, self.target_bank) / self.tau
+        return self.crossentropy_criterion(logits, labels)
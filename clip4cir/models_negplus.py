@@ -10,7 +10,8 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 from torch.utils.checkpoint import checkpoint
 from data_utils import targetpad_transform, CIRDataset
-from utils import collate_fn
+from utils import collate_fn, quantize_bank, dequantize_bank, bank_similarity, load_checkpoint, \
+    base_checkpoint_record, check_base_checkpoint
 
 
 class CIRPlus(nn.Module):
@@ -50,7 +51,13 @@ class CIRPlus(nn.Module):
         return query_features
 
     def load_ckpt(self, model_path, is_origin=False):
-        saved_state_dict = torch.load(model_path, map_location=self.device)
+        saved_state_dict = load_checkpoint(model_path)
+        base_ckpt = saved_state_dict.get('base_ckpt')
+        if base_ckpt is not None:
+            # trainable-only checkpoint (see utils.save_model), the frozen weights come from its base checkpoint
+            check_base_checkpoint(base_ckpt)
+            self.load_ckpt(base_ckpt['model_path'], base_ckpt['is_origin'])
+        self.base_ckpt = base_checkpoint_record(model_path, is_origin)
         if is_origin:
             self.clip.load_state_dict(saved_state_dict[self.clip.__class__.__name__], strict=False)
         else:
@@ -123,22 +130,38 @@ class CIRPlus(nn.Module):
             self.unlabeled_target_bank = self.unlabeled_target_bank[:self.neg_num, :]
         self.M = self.target_bank.shape[0]
         self.target_bank = torch.cat([self.target_bank, self.unlabeled_target_bank])
+        # the unlabeled features now live in target_bank (after self.M), so quantize_banks and the bank size report
+        # cover them and no fp32 copy is kept next to the quantized bank
+        del self.unlabeled_target_bank
 
     def load_refer_bank(self, bank_path):
         self.refer_bank = torch.load(bank_path)
 
-    def bank_large_step(self, loss, text_feats, indexs, target_indexs,
-                        refer_indexs=None):
+    def quantize_banks(self, precision='fp32'):
+        """
+        Keep the feature banks in a reduced storage precision, 'int8' only applies to the target bank
+        """
+        self.refer_bank = quantize_bank(self.refer_bank, 'fp16' if precision == 'int8' else precision)
+        self.target_bank = quantize_bank(self.target_bank, precision)
+
+    def bank_query_features(self, text_feats, indexs, refer_indexs=None):
         if self.plus:
-            reference_image_feats = self.refer_bank[refer_indexs].detach().to(self.device)
+            reference_image_feats = self.refer_bank[refer_indexs]
         else:
-            reference_image_feats = self.refer_bank[indexs].detach().to(self.device)
+            reference_image_feats = self.refer_bank[indexs]
+        reference_image_feats = dequantize_bank(reference_image_feats, self.device)
         query_feats = self.combining_function(reference_image_feats, text_feats)
-        query_feats = F.normalize(query_feats)
-        target_feats_all = self.target_bank.detach().to(self.device)
+        return F.normalize(query_feats)
+
+    def bank_scores(self, text, indexs, refer_indexs=None):
+        query_feats = self.bank_query_features(self.encode_text(text), indexs, refer_indexs)
+        return bank_similarity(query_feats, self.target_bank)
+
+    def bank_large_step(self, loss, text_feats, indexs, target_indexs,
+                        refer_indexs=None):
+        query_feats = self.bank_query_features(text_feats, indexs, refer_indexs)
         target_indexs = target_indexs.to(self.device)
-        target_feats = target_feats_all[target_indexs]
-        target_neg_loss = self.infonce_loss(query_feats, target_feats_all, target_indexs, tau=self.tau)
+        target_neg_loss = self.bank_infonce_loss(query_feats, target_indexs)
         loss['bank_loss'] = target_neg_loss
 
     def forward(self, text, indexs, target_indexs, refer_indexs):
@@ -152,3 +175,7 @@ class CIRPlus(nn.Module):
         if labels is None:
             labels = torch.arange(query_features.shape[0]).long().to(self.device)
         return self.crossentropy_criterion(logits, labels)
+
+    def bank_infonce_loss(self, query_features, labels):
+        logits = bank_similarity(query_features, self.target_bank) / self.tau
+        return self.crossentropy_criterion(logits, labels)
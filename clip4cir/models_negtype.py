@@ -13,7 +13,7 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 from torch.utils.checkpoint import checkpoint
 from data_utils import targetpad_transform, CIRDataset
-from utils import collate_fn
+from utils import collate_fn, load_checkpoint, base_checkpoint_record, check_base_checkpoint
 
 
 class CIRPlus(nn.Module):
@@ -85,7 +85,13 @@ class CIRPlus(nn.Module):
         return query_loss
 
     def load_ckpt(self, model_path, is_origin=False):
-        saved_state_dict = torch.load(model_path, map_location=self.device)
+        saved_state_dict = load_checkpoint(model_path)
+        base_ckpt = saved_state_dict.get('base_ckpt')
+        if base_ckpt is not None:
+            # trainable-only checkpoint (see utils.save_model), the frozen weights come from its base checkpoint
+            check_base_checkpoint(base_ckpt)
+            self.load_ckpt(base_ckpt['model_path'], base_ckpt['is_origin'])
+        self.base_ckpt = base_checkpoint_record(model_path, is_origin)
         if is_origin:
             self.clip.load_state_dict(saved_state_dict[self.clip.__class__.__name__], strict=False)
         else:
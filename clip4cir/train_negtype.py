@@ -161,7 +161,7 @@ def main():
                 best_score = cur_score
                 print("current best:", best_score)
                 if not args.nni:
-                    save_model('best', epoch, model, training_path)
+                    save_model('best', epoch, model, training_path, args.save_trainable_only)
     if args.nni:
         nni.report_final_result({'default': best_score})
 
@@ -191,6 +191,8 @@ if __name__ == '__main__':
     parser.add_argument("--reload_bank", action='store_true')
     parser.add_argument("--device", default='0')
     parser.add_argument("--bank_path", default='')
+    parser.add_argument("--save_trainable_only", action='store_true',
+                        help='only save the trainable weights and a reference to the loaded checkpoint')
     parser.add_argument("--nni", action='store_true')
     parser.add_argument("--neg_type", type=int, default=4)
 
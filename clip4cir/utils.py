@@ -1,8 +1,12 @@
+import copy
 import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
@@ -50,23 +54,299 @@ def extract_index_features(dataset: CIRDataset, model, device=torch.device('cuda
     return index_features, index_names
 
 
-def save_model(name: str, cur_epoch: int, model_to_save: nn.Module, training_path: Path):
+def save_model(name: str, cur_epoch: int, model_to_save: nn.Module, training_path: Path, trainable_only=False):
     """
     Save the weights of the model during training
     :param name: name of the file
     :param cur_epoch: current epoch
     :param model_to_save: pytorch model to be saved
     :param training_path: path associated with the training run
+    :param trainable_only: only save the parameters that require grad (and the buffers) together with a reference to
+        the checkpoint the frozen weights were loaded from (model_to_save.base_ckpt, see base_checkpoint_record), which
+        load_ckpt loads first. The full weights are saved if the model was not loaded from a checkpoint
     """
     models_path = training_path
     models_path.mkdir(exist_ok=True, parents=True)
+    save_path = str(models_path / f'{name}.pt')
+    base_ckpt = getattr(model_to_save, 'base_ckpt', None) if trainable_only else None
+    if base_ckpt is None or os.path.abspath(base_ckpt['model_path']) == os.path.abspath(save_path):
+        # no base to load the frozen weights from, or the file would reference itself, keep the full weights
+        trainable_only, base_ckpt = False, None
     torch.save({
         'epoch': cur_epoch,
-        "state_dict": model_to_save.state_dict(),
-    }, str(models_path / f'{name}.pt'))
+        "state_dict": trainable_state_dict(model_to_save) if trainable_only else model_to_save.state_dict(),
+        'base_ckpt': base_ckpt,
+    }, save_path)
     print("save model successfully")
 
 
+def trainable_state_dict(model: nn.Module):
+    """
+    State dict of the model restricted to the parameters that require grad and to the buffers
+    """
+    params = dict(model.named_parameters(remove_duplicate=False))
+    return {k: v for k, v in model.state_dict().items() if k not in params or params[k].requires_grad}
+
+
+def base_checkpoint_record(model_path, is_origin=False):
+    """
+    Reference to a checkpoint the frozen weights of a trainable-only checkpoint are loaded from (see save_model). The
+    size and mtime of the file are recorded so that a base overwritten afterwards is detected by check_base_checkpoint
+    """
+    stat = os.stat(model_path)
+    return {'model_path': os.path.abspath(model_path), 'is_origin': is_origin,
+            'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def check_base_checkpoint(base_ckpt):
+    """
+    Raise if the base checkpoint of a trainable-only checkpoint is missing or is not the file it was saved against
+    """
+    model_path = base_ckpt['model_path']
+    if not os.path.isfile(model_path):
+        raise RuntimeError(f"base checkpoint {model_path} of the trainable-only checkpoint does not exist")
+    stat = os.stat(model_path)
+    if (stat.st_size, stat.st_mtime_ns) != (base_ckpt['size'], base_ckpt['mtime_ns']):
+        raise RuntimeError(f"base checkpoint {model_path} changed since the trainable-only checkpoint was saved, "
+                           f"its frozen weights would not match")
+
+
+def load_checkpoint(model_path):
+    """
+    Load a checkpoint on the cpu with memory-mapped tensors, load_state_dict then copies them straight into the model
+    instead of materializing the whole file first
+    """
+    try:
+        return torch.load(model_path, map_location='cpu', mmap=True)
+    except RuntimeError:
+        # checkpoints in the legacy (non zip) format can not be memory-mapped
+        return torch.load(model_path, map_location='cpu')
+
+
+BANK_PRECISIONS = ['fp32', 'fp16', 'bf16', 'int8']
+BANK_DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+BANK_CHUNK_SIZE = 4096
+
+
+class Int8Bank:
+    """
+    Feature bank quantized to int8 with one fp32 scale per feature row. Only meant for banks that are used in dot
+    products (target banks), rows are dequantized to fp32 on the compute device
+    """
+
+    def __init__(self, bank: torch.Tensor):
+        bank = bank.float()
+        self.scale = bank.abs().amax(dim=-1, keepdim=True).clamp(min=1e-12) / 127
+        self.data = torch.round(bank / self.scale).to(torch.int8)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __getitem__(self, index):
+        rows = Int8Bank.__new__(Int8Bank)
+        rows.data, rows.scale = self.data[index], self.scale[index]
+        return rows
+
+    def dequantize(self, device=None):
+        return self.data.to(device).float() * self.scale.to(device)
+
+
+def quantize_bank(bank, precision='fp32'):
+    """
+    Store a fp32 feature bank in reduced precision, computation stays in fp32 (see dequantize_bank)
+    :param bank: fp32 feature bank
+    :param precision: one of BANK_PRECISIONS
+    :return: the bank in the requested storage precision
+    """
+    if precision == 'int8':
+        return Int8Bank(bank)
+    return bank.to(BANK_DTYPES[precision])
+
+
+def dequantize_bank(bank, device):
+    """
+    :return: fp32 copy of a (reduced precision) feature bank on device
+    """
+    if isinstance(bank, Int8Bank):
+        return bank.dequantize(device)
+    return bank.detach().to(device).float()
+
+
+def _chunk_similarity(query, data, scale, sim_fn):
+    chunk = data.to(query.device).float()
+    if sim_fn is not None:
+        return sim_fn(query, chunk if scale is None else chunk * scale.to(query.device))
+    sim = query @ chunk.T
+    return sim if scale is None else sim * scale.to(query.device).T
+
+
+def bank_similarity(query, bank, sim_fn=None, chunk_size=BANK_CHUNK_SIZE):
+    """
+    Similarity of the queries with every row of a (reduced precision) feature bank. The bank is converted to fp32
+    chunk_size rows at a time and the chunks are recomputed in backward instead of being kept, so no fp32 copy of the
+    whole bank is ever built
+    :param query: B x D fp32 queries on the compute device
+    :param sim_fn: sim_fn(query, fp32 bank chunk) -> B x chunk rows, by default query @ chunk.T (int8 scales are then
+        applied to the scores)
+    :return: B x M
+    """
+    data, scale = (bank.data, bank.scale) if isinstance(bank, Int8Bank) else (bank.detach(), None)
+    sims = []
+    for start in range(0, data.shape[0], chunk_size):
+        chunk_scale = None if scale is None else scale[start:start + chunk_size]
+        sims.append(checkpoint(_chunk_similarity, query, data[start:start + chunk_size], chunk_scale, sim_fn,
+                               use_reentrant=False))
+    return torch.cat(sims, dim=1)
+
+
+def bank_nbytes(bank):
+    if bank is None:
+        return 0
+    if isinstance(bank, Int8Bank):
+        return bank.data.nelement() + bank.scale.nelement() * bank.scale.element_size()
+    return bank.nelement() * bank.element_size()
+
+
+@torch.no_grad()
+def bank_recall(model, batches, ks=(1, 10, 50)):
+    """
+    Recall@k of training queries against the target bank of a stage-2 model
+    :param batches: training batches in bank mode: (captions, indexs, target_indexs, target_index_all, reference_index_all)
+    :return: dict k -> recall@k
+    """
+    hits = {k: 0 for k in ks}
+    num_queries = 0
+    training = model.training
+    model.eval()
+    for captions, indexs, target_indexs, target_index_all, reference_index_all in batches:
+        scores = model.bank_scores(captions, indexs, reference_index_all).float()
+        labels = target_index_all.to(scores.device)
+        ranks = (scores > scores.gather(1, labels.unsqueeze(1))).sum(dim=1)
+        for k in ks:
+            hits[k] += (ranks < k).sum().item()
+        num_queries += len(labels)
+    model.train(training)
+    return {k: hits[k] / num_queries * 100 for k in ks}
+
+
+def bank_recall_peak(model, batches, ks=(1, 10, 50)):
+    """
+    :return: bank_recall of the batches (None without batches) and the peak cuda memory allocated on top of the
+        memory already in use while scoring them (None without batches or cuda)
+    """
+    if not batches:
+        return None, None
+    if not torch.cuda.is_available():
+        return bank_recall(model, batches, ks), None
+    torch.cuda.synchronize()
+    allocated = torch.cuda.memory_allocated()
+    torch.cuda.reset_peak_memory_stats()
+    recall = bank_recall(model, batches, ks)
+    torch.cuda.synchronize()
+    return recall, torch.cuda.max_memory_allocated() - allocated
+
+
+def set_bank_precision(model, precision, data_loader=None, num_batches=20, ks=(1, 10, 50)):
+    """
+    Switch the feature banks of a stage-2 model to a storage precision, printing the resident bank memory and, if
+    data_loader is given, the recall@k of num_batches training batches against the target bank and the peak cuda memory
+    of scoring them before and after
+    :param precision: one of BANK_PRECISIONS, 'int8' only applies to the target bank, the reference bank is kept in fp16
+    """
+    if precision == 'fp32':
+        return
+    batches = []
+    if data_loader is not None and num_batches > 0:
+        for batch in data_loader:
+            batches.append(batch)
+            if len(batches) == num_batches:
+                break
+    fp32_recall, fp32_peak = bank_recall_peak(model, batches, ks)
+    fp32_nbytes = bank_nbytes(model.refer_bank) + bank_nbytes(model.target_bank)
+    model.quantize_banks(precision)
+    nbytes = bank_nbytes(model.refer_bank) + bank_nbytes(model.target_bank)
+    recall, peak = bank_recall_peak(model, batches, ks)
+    print(f"bank memory: {fp32_nbytes / 2 ** 20:.1f} MB (fp32) -> {nbytes / 2 ** 20:.1f} MB ({precision})")
+    if peak is not None:
+        print(f"bank scoring peak memory: {fp32_peak / 2 ** 20:.1f} MB (fp32) -> {peak / 2 ** 20:.1f} MB ({precision})")
+    if batches:
+        for k in ks:
+            print(f"bank recall@{k}: {fp32_recall[k]:.2f} (fp32) -> {recall[k]:.2f} ({precision}), "
+                  f"delta {recall[k] - fp32_recall[k]:+.2f}")
+
+
+def shared_copy(model: nn.Module):
+    """
+    Copy of the model that only duplicates the trainable parameters, the frozen parameters, the buffers and the
+    tensors held as attributes (e.g. the feature banks) are shared with the model
+    """
+    memo = {id(param): param for param in model.parameters() if not param.requires_grad}
+    memo.update({id(buffer): buffer for buffer in model.buffers()})
+    for module in model.modules():
+        for value in vars(module).values():
+            if isinstance(value, (torch.Tensor, Int8Bank)):
+                memo[id(value)] = value
+    return copy.deepcopy(model, memo)
+
+
+class AsyncValidator:
+    """
+    Run the validation of a model in a background thread so that the training loop does not wait for it. Validation
+    runs validate_fn(val_model, epoch) on a copy of the model (see shared_copy) whose trainable parameters are set to
+    the ones of the model when the epoch is submitted, so its metrics and the saved weights belong to that epoch
+
+    Example:
+    ```
+    validator = AsyncValidator(model, validate)
+    for epoch in range(num_epochs):
+        train_one_epoch(model)
+        validator.submit(model, epoch)
+    validator.close()
+    ```
+    """
+
+    def __init__(self, model: nn.Module, validate_fn):
+        self.val_model = shared_copy(model)
+        self.val_params = dict(self.val_model.named_parameters())
+        self.validate_fn = validate_fn
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+    def submit(self, model: nn.Module, epoch: int):
+        """
+        Snapshot the trainable parameters of the model and validate them in the background, waits for the previous
+        validation if it is still running
+        """
+        self.wait()
+        with torch.no_grad():
+            for name, param in model.named_parameters():
+                if param.requires_grad:
+                    self.val_params[name].copy_(param)
+        if self.stream is not None:
+            self.stream.wait_stream(torch.cuda.current_stream())
+        self.future = self.executor.submit(self._validate, epoch)
+
+    def _validate(self, epoch):
+        if self.stream is None:
+            return self.validate_fn(self.val_model, epoch)
+        with torch.cuda.stream(self.stream):
+            return self.validate_fn(self.val_model, epoch)
+
+    def wait(self):
+        """
+        Wait for the running validation, errors raised by validate_fn are raised here
+        """
+        if self.future is not None:
+            future, self.future = self.future, None
+            return future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
 class RunningAverage():
     """A simple class that maintains the running average of a quantity
 
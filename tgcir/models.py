@@ -12,10 +12,10 @@ from tqdm import tqdm
 
 import clip
 import torch.nn.functional as F
-from torch.autograd import Variable
 from torch.utils.checkpoint import checkpoint
 from data_utils import targetpad_transform, CIRDataset
-from utils import collate_fn
+from utils import collate_fn, quantize_bank, dequantize_bank, bank_similarity, load_checkpoint, \
+    base_checkpoint_record, check_base_checkpoint
 
 
 class SpatialAttention(nn.Module):
@@ -42,17 +42,19 @@ class TokenLearner(nn.Module):
 
     def forward(self, x):
         B, L, C = x.shape
-        Z = torch.Tensor(B, self.S, C).cuda()  # (B,8,1024)
-        for i in range(self.S):
-            Ai, _ = self.tokenizers[i](x)
-            Z[:, i, :] = Ai
+        # all S 1x1 convs at once: (S,C,1) weights over (B,C,L) -> (B,S,L) spatial weight maps
+        weight = torch.cat([tokenizer.conv[0].weight for tokenizer in self.tokenizers], dim=0)
+        bias = torch.cat([tokenizer.conv[0].bias for tokenizer in self.tokenizers], dim=0)
+        weight_map = torch.sigmoid(F.conv1d(x.permute(0, 2, 1), weight, bias))
+        Z = torch.bmm(weight_map, x) / L  # (B,S,L) @ (B,L,C) => (B,S,C), mean of the weighted positions
         return Z
 
 
 class Backbone(nn.Module):
-    def __init__(self, img_encoder='ViT-B/16', hidden_dim=512, dropout=0.0, local_token_num=8, global_token_num=4):
+    def __init__(self, img_encoder='ViT-B/16', hidden_dim=512, dropout=0.0, local_token_num=8, global_token_num=4,
+                 device='cuda'):
         super().__init__()
-        self.clip, self.preprocess = clip.load(img_encoder, device='cuda', jit=False)
+        self.clip, self.preprocess = clip.load(img_encoder, device=device, jit=False)
         self.clip = self.clip.float()
         self.image_backbone = self.clip.visual
         self.img_encoder = img_encoder
@@ -75,6 +77,15 @@ class Backbone(nn.Module):
         self.tokenlearn_text = copy.deepcopy(self.tokenlearn)
         self.masks_text = copy.deepcopy(self.masks)
 
+    @staticmethod
+    def global_tokens(global_fea, masks):
+        """
+        :param global_fea: (B, D) pooled features
+        :param masks: Embedding of global_token_num concept masks
+        :return: (B, global_token_num, D) masked copies of global_fea
+        """
+        return global_fea.unsqueeze(1) * F.relu(masks.weight).unsqueeze(0)
+
     def extract_img_fea(self, x):
         x = self.image_backbone.conv1(x)  # shape = [*, width, grid, grid]
         x = x.reshape(x.shape[0], x.shape[1], -1)  # shape = [*, width, grid ** 2]
@@ -93,25 +104,13 @@ class Backbone(nn.Module):
         global_fea = self.image_backbone.ln_post(x[:, 0, :]) @ self.image_backbone.proj
 
         # mask_norm = None
-        global_tokens = []
-        for idx in range(self.global_token_num):
-            concept_idx = np.zeros((len(x),), dtype=int)
-            concept_idx += idx
-            concept_idx = torch.from_numpy(concept_idx)
-            concept_idx = concept_idx.cuda()
-            concept_idx = Variable(concept_idx)
-            self.mask = self.masks(concept_idx)
-            self.mask = torch.nn.functional.relu(self.mask)
-            masked_embedding = global_fea * self.mask  # batch_size, dim
-            global_tokens.append(masked_embedding)
-        global_tokens = torch.stack(global_tokens).permute(1, 0, 2).contiguous()
-
-        local_fea = self.fc(x.float())
+        global_tokens = self.global_tokens(global_fea, self.masks)
+
         local_tokens = self.tokenlearn(self.fc(x.float()))
         return torch.cat([global_tokens, local_tokens], dim=1)
 
     def extract_text_fea(self, txt):
-        text = clip.tokenize(txt).cuda()
+        text = clip.tokenize(txt).to(self.clip.positional_embedding.device)
 
         x = self.clip.token_embedding(text).type(self.clip.dtype)  # [batch_size, n_ctx, d_model]
 
@@ -122,18 +121,7 @@ class Backbone(nn.Module):
         x = self.clip.ln_final(x).type(self.clip.dtype)
         global_fea = x[torch.arange(x.shape[0]), text.argmax(dim=-1)] @ self.clip.text_projection
 
-        global_tokens = []
-        for idx in range(self.global_token_num):
-            concept_idx = np.zeros((len(x),), dtype=int)
-            concept_idx += idx
-            concept_idx = torch.from_numpy(concept_idx)
-            concept_idx = concept_idx.cuda()
-            concept_idx = Variable(concept_idx)
-            self.mask = self.masks_text(concept_idx)
-            self.mask = torch.nn.functional.relu(self.mask)
-            masked_embedding = global_fea * self.mask  # batch_size, dim
-            global_tokens.append(masked_embedding)
-        global_tokens = torch.stack(global_tokens).permute(1, 0, 2).contiguous()
+        global_tokens = self.global_tokens(global_fea, self.masks_text)
         local_tokens = self.tokenlearn_text(self.text_fc(x.float()))
 
         return torch.cat([global_tokens, local_tokens], dim=1)
@@ -149,7 +137,7 @@ class CIRPlus(nn.Module):
         # initial main model
         self.device = device
         self.tau = tau
-        self.backbone = Backbone(clip_model_name, 512, 0, local_token_num, global_token_num)
+        self.backbone = Backbone(clip_model_name, 512, 0, local_token_num, global_token_num, device)
         self.input_dim = self.backbone.clip.visual.input_resolution
         print("image size:", self.input_dim)
         self.output_dim = self.backbone.clip.visual.output_dim
@@ -205,7 +193,13 @@ class CIRPlus(nn.Module):
         return s_fuse_local
 
     def load_ckpt(self, model_path, is_origin=False):
-        saved_state_dict = torch.load(model_path, map_location=self.device)
+        saved_state_dict = load_checkpoint(model_path)
+        base_ckpt = saved_state_dict.get('base_ckpt')
+        if base_ckpt is not None:
+            # trainable-only checkpoint (see utils.save_model), the frozen weights come from its base checkpoint
+            check_base_checkpoint(base_ckpt)
+            self.load_ckpt(base_ckpt['model_path'], base_ckpt['is_origin'])
+        self.base_ckpt = base_checkpoint_record(model_path, is_origin)
         self.load_state_dict(saved_state_dict['state_dict'], strict=False)
         if is_origin:
             # for stage2
@@ -220,65 +214,87 @@ class CIRPlus(nn.Module):
             for param in self.backbone.masks.parameters():
                 param.requires_grad = False
 
-    def extract_bank_features(self, cirDataset: CIRDataset, device, bank_path, reload_bank=False):
+    def extract_bank_features(self, cirDataset: CIRDataset, device, bank_path, reload_bank=False,
+                              refer_bank_path=None):
+        """
+        Compute or load the reference token bank and the target bank, both keyed by image. If refer_bank_path is
+        given, the reference tokens of the target images are encoded in the same pass and the resulting bank of all
+        images, used with additional data (see load_refer_bank), is saved there
+        """
         self.eval().float()
-        if not os.path.exists(bank_path) or reload_bank:
-            self.refer_bank = torch.zeros(len(cirDataset), 12, 512)
+        build_refer_bank = refer_bank_path is not None and (not os.path.exists(refer_bank_path) or reload_bank)
+        if os.path.exists(bank_path) and not reload_bank and not build_refer_bank:
+            self.refer_bank, self.target_bank = torch.load(bank_path)
+            # banks saved before the reference bank was keyed by image hold one entry per triplet
+            reload_bank = len(self.refer_bank) != cirDataset.image_id
+        if not os.path.exists(bank_path) or reload_bank or build_refer_bank:
+            # many triplets share a reference image, so reference tokens are stored once per image and looked up
+            # through reference_index_all like the target bank
+            self.refer_bank = torch.zeros(cirDataset.image_id, 12, 512)
             self.target_bank = torch.zeros(cirDataset.image_id, 512)
+            refer_encoded = torch.zeros(cirDataset.image_id, dtype=torch.bool)
+            target_encoded = torch.zeros(cirDataset.image_id, dtype=torch.bool)
             data_loader = DataLoader(dataset=cirDataset, batch_size=32, num_workers=multiprocessing.cpu_count(),
                                      pin_memory=True, collate_fn=collate_fn)
             for reference_image, caption, target_image, index, \
                 target_index, reference_index_all, target_index_all in tqdm(
                 data_loader, desc='encoding bank features...'):
-                reference_image = reference_image.to(device, non_blocking=True)
-                target_image = target_image.to(device, non_blocking=True)
+                # only encode the images that are not in the banks yet
+                new_refer = ~refer_encoded[reference_index_all]
+                new_target = ~target_encoded[target_index_all]
+                reference_index_all = reference_index_all[new_refer]
+                target_index_all = target_index_all[new_target]
+                reference_image = reference_image[new_refer].to(device, non_blocking=True)
+                target_image = target_image[new_target].to(device, non_blocking=True)
 
                 with torch.no_grad():
-                    batch_refer_features = self.img_embed(reference_image, return_pool_and_normalized=True)
-                    batch_target_features_p = self.img_embed(target_image, return_pool_and_normalized=True)[
-                        -1].detach().cpu()
-                    batch_refer_features_p = batch_refer_features[1].detach().cpu()
-                    batch_refer_features = batch_refer_features[0].detach().cpu()
-                    self.refer_bank[index] = batch_refer_features
-                    self.target_bank[reference_index_all] = batch_refer_features_p
-                    self.target_bank[target_index_all] = batch_target_features_p
+                    if len(reference_index_all) > 0:
+                        batch_refer_features, batch_refer_features_p = self.img_embed(
+                            reference_image, return_pool_and_normalized=True)
+                        batch_refer_features = batch_refer_features.detach().cpu()
+                        batch_refer_features_p = batch_refer_features_p.detach().cpu()
+                        self.refer_bank[reference_index_all] = batch_refer_features
+                        self.target_bank[reference_index_all] = batch_refer_features_p
+                    if len(target_index_all) > 0:
+                        batch_target_features, batch_target_features_p = self.img_embed(
+                            target_image, return_pool_and_normalized=True)
+                        self.target_bank[target_index_all] = batch_target_features_p.detach().cpu()
+                        if refer_bank_path is not None:
+                            self.refer_bank[target_index_all] = batch_target_features.detach().cpu()
+                refer_encoded[reference_index_all] = True
+                target_encoded[reference_index_all] = True
+                target_encoded[target_index_all] = True
+                if refer_bank_path is not None:
+                    refer_encoded[target_index_all] = True
             torch.save([self.refer_bank, self.target_bank], bank_path)
-        else:
-            self.refer_bank, self.target_bank = torch.load(bank_path)
+            if refer_bank_path is not None:
+                torch.save(self.refer_bank, refer_bank_path)
         print("load bank successfully")
 
-    def extract_refer_bank_features(self, cirDataset: CIRDataset, device, bank_path, reload_bank=False):
-        self.eval().float()
-        if not os.path.exists(bank_path) or reload_bank:
-            self.refer_bank = torch.zeros(cirDataset.image_id, 12, 512)
-            data_loader = DataLoader(dataset=cirDataset, batch_size=32, num_workers=multiprocessing.cpu_count(),
-                                     pin_memory=True, collate_fn=collate_fn)
-            for reference_image, caption, target_image, index, \
-                target_index, reference_index_all, target_index_all in tqdm(
-                data_loader, desc='encoding bank features...'):
-                reference_image = reference_image.to(device, non_blocking=True)
-                target_image = target_image.to(device, non_blocking=True)
-                with torch.no_grad():
-                    batch_refer_features = self.img_embed(reference_image).detach().cpu()
-                    batch_target_features = self.img_embed(target_image).detach().cpu()
-                    self.refer_bank[reference_index_all] = batch_refer_features
-                    self.refer_bank[target_index_all] = batch_target_features
-            torch.save(self.refer_bank, bank_path)
-        print("load reference bank successfully")
-
     def load_refer_bank(self, bank_path):
         self.refer_bank = torch.load(bank_path)
 
+    def quantize_banks(self, precision='fp32'):
+        """
+        Keep the feature banks in a reduced storage precision, 'int8' only applies to the target bank
+        """
+        self.refer_bank = quantize_bank(self.refer_bank, 'fp16' if precision == 'int8' else precision)
+        self.target_bank = quantize_bank(self.target_bank, precision)
+
+    def bank_query_features(self, text, indexs, refer_indexs=None):
+        # the reference bank is keyed by image (see extract_bank_features), with or without additional data
+        reference_image_feats = dequantize_bank(self.refer_bank[refer_indexs], self.device)
+        return self.img_txt_fusion(reference_image_feats, text)
+
+    def bank_scores(self, text, indexs, refer_indexs=None):
+        query_feats = self.bank_query_features(text, indexs, refer_indexs)
+        return bank_similarity(query_feats, self.target_bank)
+
     def bank_large_step(self, loss, text, indexs, target_indexs,
                         refer_indexs=None):
-        if self.plus:
-            reference_image_feats = self.refer_bank[refer_indexs].detach().to(self.device)
-        else:
-            reference_image_feats = self.refer_bank[indexs].detach().to(self.device)
-        query_feats = self.img_txt_fusion(reference_image_feats, text)
-        target_feats_all = self.target_bank.detach().to(self.device)
+        query_feats = self.bank_query_features(text, indexs, refer_indexs)
         target_indexs = target_indexs.to(self.device)
-        target_neg_loss = self.infonce_loss(query_feats, target_feats_all, target_indexs, tau=self.tau)
+        target_neg_loss = self.bank_infonce_loss(query_feats, target_indexs)
         loss['bank_loss'] = target_neg_loss
 
     def forward(self, text, indexs, target_indexs, refer_indexs, refer_image=None, target_image=None):
@@ -291,3 +307,7 @@ class CIRPlus(nn.Module):
         if labels is None:
             labels = torch.arange(query_features.shape[0]).long().to(self.device)
         return self.crossentropy_criterion(logits, labels)
+
+    def bank_infonce_loss(self, query_features, labels):
+        logits = bank_similarity(query_features, self.target_bank) / self.tau
+        return self.crossentropy_criterion(logits, labels)
@@ -0,0 +1,167 @@
+import json
+import os
+import subprocess
+import sys
+
+from tqdm import tqdm
+
+
+def shard_it_list(it_list, num_shards, shard_id):
+    """
+    Deterministically split an image-text list across workers
+    :param it_list: list of {"image_id", "image_path", "caption"} items
+    :param num_shards: number of workers
+    :param shard_id: index of the current worker
+    :return: the items of this worker, in their original order
+    """
+    if num_shards <= 1:
+        return it_list
+    return it_list[shard_id::num_shards]
+
+
+def shard_path(output_path, shard_id, num_shards):
+    """
+    JSONL shard file of a caption json, e.g. mm_data/cirr/cirr_it_llava_10.json -> mm_data/cirr/cirr_it_llava_10.1of4.jsonl
+    """
+    root, _ = os.path.splitext(output_path)
+    return f"{root}.{shard_id}of{num_shards}.jsonl"
+
+
+def read_shard(path):
+    """
+    Read the captioned items of a JSONL shard, ignoring a truncated last line left by a crash
+    :return: dict image_id -> item
+    """
+    id2it = dict()
+    if not os.path.exists(path):
+        return id2it
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line == '':
+                continue
+            try:
+                it = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            id2it[it['image_id']] = it
+    return id2it
+
+
+class CaptionJob:
+    """
+    Append-only JSONL writer for one caption shard, flushed to disk every flush_every items so that a
+    restarted job skips the images that are already captioned
+
+    Example:
+    ```
+    with CaptionJob(shard_path(output_path, 0, 1)) as job:
+        for it in tqdm(job.pending(it_list)):
+            it['caption'] = generate_caption(it['image_path'], prompt)
+            job.write(it)
+    ```
+    """
+
+    def __init__(self, path, flush_every=64):
+        self.path = path
+        self.flush_every = flush_every
+        self.done = read_shard(path)
+        self.num_unflushed = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+        if self.file.tell() > 0:
+            # terminate a truncated last line so that new records start on their own line
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.file.write('\n')
+
+    def pending(self, it_list):
+        """
+        :return: the items of it_list that are not captioned in this shard yet
+        """
+        return [it for it in it_list if it['image_id'] not in self.done]
+
+    def write(self, it):
+        self.file.write(json.dumps(it, ensure_ascii=False) + '\n')
+        self.done[it['image_id']] = it
+        self.num_unflushed += 1
+        if self.num_unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.num_unflushed = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def batched_caption_fn(batch_fn, batch_size):
+    """
+    Turn a function captioning one batch of items into a caption_fn for run_caption_job
+    """
+
+    def caption_fn(it_list):
+        for i in range(0, len(it_list), batch_size):
+            yield from batch_fn(it_list[i:i + batch_size])
+
+    return caption_fn
+
+
+def run_caption_job(it_list, caption_fn, output_path, shard_id=0, num_shards=1, flush_every=64):
+    """
+    Caption the shard_id-th shard of it_list into its JSONL shard, resuming from what is already there
+    :param caption_fn: function mapping a list of items to an iterable of their captions (in order), captions are
+        written as soon as they are yielded
+    :return: path of the JSONL shard
+    """
+    path = shard_path(output_path, shard_id, num_shards)
+    with CaptionJob(path, flush_every=flush_every) as job:
+        pending = job.pending(shard_it_list(it_list, num_shards, shard_id))
+        print(f"shard {shard_id}/{num_shards}: {len(job.done)} captioned, {len(pending)} to caption")
+        for it, caption in zip(pending, tqdm(caption_fn(pending), total=len(pending))):
+            it['caption'] = caption
+            job.write(it)
+    return path
+
+
+def merge_shards(it_list, output_path, num_shards):
+    """
+    Merge the JSONL shards of a caption job into the single caption json, keeping the order of it_list
+    """
+    id2it = dict()
+    for shard_id in range(num_shards):
+        id2it.update(read_shard(shard_path(output_path, shard_id, num_shards)))
+    missing = [it['image_id'] for it in it_list if it['image_id'] not in id2it]
+    if len(missing) > 0:
+        raise RuntimeError(f"{len(missing)} images are not captioned yet (e.g. {missing[0]}), rerun the caption job")
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps([id2it[it['image_id']] for it in it_list], ensure_ascii=False))
+    print(f"merged {len(it_list)} captions into {output_path}")
+
+
+def launch_shards(num_shards, gpus=None):
+    """
+    Re-run the current script once per shard in parallel worker processes (one GPU each if gpus is given)
+    and wait for all of them
+    """
+    procs = []
+    for shard_id in range(num_shards):
+        env = os.environ.copy()
+        if gpus:
+            env['CUDA_VISIBLE_DEVICES'] = str(gpus[shard_id % len(gpus)])
+        argv = [sys.executable, sys.argv[0]] + sys.argv[1:] + ['--shard_id', str(shard_id)]
+        procs.append(subprocess.Popen(argv, env=env))
+    codes = [proc.wait() for proc in procs]
+    if any(code != 0 for code in codes):
+        raise RuntimeError(f"caption workers failed with exit codes {codes}")
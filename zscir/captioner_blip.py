@@ -2,13 +2,17 @@ import os
 
 os.environ['HF_ENDPOINT'] = "https://hf-mirror.com"
 import argparse
-import json
+import sys
+import time
+from itertools import groupby
 
 from PIL import Image
 from tqdm import tqdm
 
+from caption_job import run_caption_job, merge_shards, launch_shards
 from data_process import get_fiq_it, get_cirr_it, get_cc_it
 import torch
+from torch.utils.data import Dataset, DataLoader
 from lavis.models import load_model_and_preprocess
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -25,13 +29,79 @@ def generate_caption(image_path, prompt):
     return res
 
 
+class CaptionImageDataset(Dataset):
+    """
+    Decodes and preprocesses the images of an image-text list in DataLoader workers
+    """
+
+    def __init__(self, it_list, vis_processor):
+        self.image_paths = [it['image_path'] for it in it_list]
+        self.vis_processor = vis_processor
+
+    def __getitem__(self, index):
+        return self.vis_processor(Image.open(self.image_paths[index]).convert('RGB'))
+
+    def __len__(self):
+        return len(self.image_paths)
+
+
+def generate_captions(it_list, prompt, batch_size=64, num_workers=8):
+    """
+    Caption an image-text list in batches, yielding the captions in the order of it_list
+    """
+    dataset = CaptionImageDataset(it_list, vis_processors["eval"])
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True, shuffle=False)
+    start_time = time.time()
+    for images in loader:
+        images = images.to(device, non_blocking=True)
+        with torch.no_grad():
+            yield from model.generate({"image": images, "prompt": prompt})
+    elapsed = time.time() - start_time
+    print(f"captioned {len(dataset)} images in {elapsed:.1f}s ({len(dataset) / max(elapsed, 1e-6):.2f} images/sec)")
+
+
+def get_caption_tasks(args):
+    """
+    :return: list of (image-text list, output caption json, image_id -> captioning instruction)
+    """
+    if args.cir_data == 'fiq':
+        type2itlist = get_fiq_it()
+        all_it_list = []
+        id2prompt = dict()
+        for dress_type in args.dress_type.split(','):
+            it_list = type2itlist[dress_type]
+            for it in it_list:
+                id2prompt[it['image_id']] = f'please briefly describe the {dress_type} in 5 words'
+            all_it_list.extend(it_list)
+        return [(all_it_list, f"mm_data/fiq/fashioniq_it_{args.model_name}.json", id2prompt)]
+    if args.cir_data == 'cirr':
+        it_list = get_cirr_it()
+        output_path = f"mm_data/cirr/cirr_it_{args.model_name}.json"
+    else:
+        it_list = get_cc_it(args.cc_id)
+        output_path = f"mm_data/zs/cc_it_{args.cc_id}_{args.model_name}.json"
+    return [(it_list, output_path, {it['image_id']: f'please briefly describe the image in 10 words' for it in it_list})]
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--model_name", default="blip", choices=['blip', 'blip2'])
     parser.add_argument("--dress_type", default='dress,shirt,toptee')
     parser.add_argument("--cir_data", default="fiq")
     parser.add_argument("--cc_id", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--num_shards", type=int, default=1)
+    parser.add_argument("--shard_id", type=int, default=-1, help="-1 runs all shards and merges them")
+    parser.add_argument("--gpus", default=None, help="comma separated gpu ids for the shard workers")
+    parser.add_argument("--flush_every", type=int, default=64)
     args = parser.parse_args()
+    if args.shard_id < 0 and args.num_shards > 1:
+        # caption every shard in its own worker process, then merge the shards
+        launch_shards(args.num_shards, args.gpus.split(',') if args.gpus else None)
+        for it_list, output_path, _ in get_caption_tasks(args):
+            merge_shards(it_list, output_path, args.num_shards)
+        sys.exit(0)
     if args.model_name == 'blip':
         model, vis_processors, _ = load_model_and_preprocess(name="blip_caption", model_type="base_coco", is_eval=True,
                                                              device="cuda")
@@ -39,35 +109,13 @@ if __name__ == "__main__":
         model, vis_processors, _ = load_model_and_preprocess(
             name="blip2_opt", model_type="pretrain_opt2.7b", is_eval=True, device="cuda"
         )
-    if args.cir_data == 'fiq':
-        type2itlist = get_fiq_it()
-        dress_types = args.dress_type.split(',')
-        all_it_list = []
-        for dress_type in dress_types:
-            it_list = type2itlist[dress_type]
-            prompt = f'please briefly describe the {dress_type} in 5 words'
-            for it in tqdm(it_list):
-                image_path = it['image_path']
-                it['caption'] = generate_caption(image_path, prompt)
-                # print(it['caption'])
-            # with open(f"/root_path/cirdata/fashioniq_{dress_type}_it.json", 'w', encoding='utf-8') as f:
-            #     f.write(json.dumps(it_list, ensure_ascii=False))
-            all_it_list.extend(it_list)
-        with open(f"mm_data/fiq/fashioniq_it_{args.model_name}.json", 'w', encoding='utf-8') as f:
-            f.write(json.dumps(all_it_list, ensure_ascii=False))
-    elif args.cir_data == 'cirr':
-        it_list = get_cirr_it()
-        prompt = f'please briefly describe the image in 10 words'
-        for it in tqdm(it_list):
-            image_path = it['image_path']
-            it['caption'] = generate_caption(image_path, prompt)
-        with open(f"mm_data/cirr/cirr_it_{args.model_name}.json", 'w', encoding='utf-8') as f:
-            f.write(json.dumps(it_list, ensure_ascii=False))
-    elif args.cir_data == 'cc':
-        it_list = get_cc_it(args.cc_id)
-        prompt = f'please briefly describe the image in 10 words'
-        for it in tqdm(it_list):
-            image_path = it['image_path']
-            it['caption'] = generate_caption(image_path, prompt)
-        with open(f"mm_data/zs/cc_it_{args.cc_id}_{args.model_name}.json", 'w', encoding='utf-8') as f:
-            f.write(json.dumps(it_list, ensure_ascii=False))
+    for it_list, output_path, id2prompt in get_caption_tasks(args):
+        def caption_fn(pending):
+            # generate takes one prompt per call, so consecutive images with the same prompt are batched together
+            for prompt, group in groupby(pending, key=lambda it: id2prompt[it['image_id']]):
+                yield from generate_captions(list(group), prompt, args.batch_size, args.num_workers)
+
+        run_caption_job(it_list, caption_fn, output_path, max(args.shard_id, 0), args.num_shards,
+                        flush_every=args.flush_every)
+        if args.shard_id < 0:
+            merge_shards(it_list, output_path, args.num_shards)
@@ -1,16 +1,17 @@
 import argparse
-import json
+import sys
 
 import torch
-from tqdm import tqdm
 
+from caption_job import run_caption_job, batched_caption_fn, merge_shards, launch_shards
 from data_process import get_fiq_it, get_cirr_it, get_cc_it
 
 from llava.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 from llava.conversation import conv_templates, SeparatorStyle
 from llava.model.builder import load_pretrained_model
 from llava.utils import disable_torch_init
-from llava.mm_utils import tokenizer_image_token, get_model_name_from_path, KeywordsStoppingCriteria
+from llava.mm_utils import tokenizer_image_token, get_model_name_from_path, KeywordsStoppingCriteria, \
+    BatchKeywordsStoppingCriteria
 
 from PIL import Image
 
@@ -19,6 +20,11 @@ from PIL import Image
 from io import BytesIO
 from transformers import TextStreamer
 
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+
 
 def load_image(image_file):
     if image_file.startswith('http') or image_file.startswith('https'):
@@ -29,37 +35,168 @@ def load_image(image_file):
     return image
 
 
-def generate_caption(args, prompt, image=None):
-    image = load_image(args.image_file) if image is None else image
-    image_tensor = image_processor.preprocess(image, return_tensors='pt')['pixel_values'].half().cuda()
+def caption_max_new_tokens(k, tokens_per_word=2, margin=8):
+    """
+    Generation budget for a caption of about k words, leaving room for punctuation and the stop sequence
+    """
+    return k * tokens_per_word + margin
+
+
+def build_caption_prompt(prompt, model, conv_mode):
+    """
+    Build the full conversation prompt (with the image placeholder) for a captioning instruction
+    :return: prompt string and stop string of the conversation template
+    """
+    conv = conv_templates[conv_mode].copy()
     inp = f"user: {prompt}"
-    # first message
     if model.config.mm_use_im_start_end:
         inp = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n' + inp
     else:
         inp = DEFAULT_IMAGE_TOKEN + '\n' + inp
     conv.append_message(conv.roles[0], inp)
     conv.append_message(conv.roles[1], None)
-    prompt = conv.get_prompt()
-
-    input_ids = tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).cuda()
     stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
-    keywords = [stop_str]
-    stopping_criteria = KeywordsStoppingCriteria(keywords, tokenizer, input_ids)
+    return conv.get_prompt(), stop_str
+
+
+def left_pad_embeds(batch_embeds):
+    """
+    Left-pad a list of [seq_len, hidden] embeddings into one batch
+    :return: inputs_embeds of shape [batch, max_len, hidden] and the matching attention_mask
+    """
+    max_len = max(embeds.shape[0] for embeds in batch_embeds)
+    inputs_embeds = batch_embeds[0].new_zeros(len(batch_embeds), max_len, batch_embeds[0].shape[-1])
+    attention_mask = torch.zeros(len(batch_embeds), max_len, dtype=torch.long, device=inputs_embeds.device)
+    for i, embeds in enumerate(batch_embeds):
+        inputs_embeds[i, max_len - embeds.shape[0]:] = embeds
+        attention_mask[i, max_len - embeds.shape[0]:] = 1
+    return inputs_embeds, attention_mask
+
+
+class CaptionPromptCache:
+    """
+    Caches, for a captioning run, the tokenized prompts, the embedded text around the image placeholder and the
+    KV cache of the text before it. The system prompt and the instruction are the same for every image, so only the
+    image tokens and the text after them (which attends to the image) go through the language model per caption.
+    """
+
+    def __init__(self, model, tokenizer, conv_mode):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.conv_mode = conv_mode
+        self.segments = dict()
+        self.prefixes = dict()
+
+    def get(self, prompt):
+        """
+        :return: prefix key, prefix embeddings, suffix embeddings and stop string of a captioning instruction
+        """
+        if prompt not in self.segments:
+            full_prompt, stop_str = build_caption_prompt(prompt, self.model, self.conv_mode)
+            input_ids = tokenizer_image_token(full_prompt, self.tokenizer, IMAGE_TOKEN_INDEX,
+                                              return_tensors='pt').to(self.model.device)
+            image_pos = torch.where(input_ids == IMAGE_TOKEN_INDEX)[0][0]
+            embed_tokens = self.model.get_model().embed_tokens
+            with torch.inference_mode():
+                prefix_embeds = embed_tokens(input_ids[:image_pos])
+                suffix_embeds = embed_tokens(input_ids[image_pos + 1:])
+            prefix_key = tuple(input_ids[:image_pos].tolist())
+            self.segments[prompt] = (prefix_key, prefix_embeds, suffix_embeds, stop_str)
+        return self.segments[prompt]
+
+    def past_key_values(self, prefix_key, prefix_embeds, batch_size):
+        """
+        KV cache of a prompt prefix, computed once and expanded to the batch size
+        """
+        if prefix_key not in self.prefixes:
+            with torch.inference_mode():
+                past = self.model(inputs_embeds=prefix_embeds.unsqueeze(0), use_cache=True).past_key_values
+            if hasattr(past, 'to_legacy_cache'):
+                past = past.to_legacy_cache()
+            self.prefixes[prefix_key] = past
+        past = tuple((k.expand(batch_size, -1, -1, -1), v.expand(batch_size, -1, -1, -1))
+                     for k, v in self.prefixes[prefix_key])
+        # generate extends the cache in place, so every batch gets a fresh cache object
+        return DynamicCache.from_legacy_cache(past) if DynamicCache is not None else past
+
+
+def generate_captions(image_files, prompts, model, tokenizer, image_processor, prompt_cache, max_new_tokens=32,
+                      do_sample=True):
+    """
+    Caption a batch of images with one generate call
+    :param image_files: image paths (or urls) of the batch
+    :param prompts: captioning instruction per image, or one instruction shared by the whole batch
+    :param prompt_cache: CaptionPromptCache of the model
+    :return: list of captions aligned with image_files
+    """
+    if isinstance(prompts, str):
+        prompts = [prompts] * len(image_files)
+    images = [load_image(image_file) for image_file in image_files]
+    image_tensor = image_processor.preprocess(images, return_tensors='pt')['pixel_values']
+    image_tensor = image_tensor.to(model.device, dtype=model.dtype)
+    segments = [prompt_cache.get(prompt) for prompt in prompts]
+    stop_str = segments[0][-1]
 
     with torch.inference_mode():
+        image_features = model.encode_images(image_tensor)
+        span_embeds = [torch.cat([image_feature.to(suffix_embeds.dtype), suffix_embeds], dim=0)
+                       for image_feature, (_, _, suffix_embeds, _) in zip(image_features, segments)]
+        past_key_values = None
+        if len(set(segment[0] for segment in segments)) == 1:
+            # shared prefix: its KV cache is reused and the padding goes between prefix and image
+            prefix_key, prefix_embeds = segments[0][:2]
+            span_embeds, span_mask = left_pad_embeds(span_embeds)
+            inputs_embeds = torch.cat([prefix_embeds.unsqueeze(0).expand(len(images), -1, -1), span_embeds], dim=1)
+            attention_mask = torch.cat([span_mask.new_ones(len(images), prefix_embeds.shape[0]), span_mask], dim=1)
+            past_key_values = prompt_cache.past_key_values(prefix_key, prefix_embeds, len(images))
+        else:
+            inputs_embeds, attention_mask = left_pad_embeds(
+                [torch.cat([segment[1], embeds], dim=0) for segment, embeds in zip(segments, span_embeds)])
+        # generation from inputs_embeds only returns the new tokens
+        stopping_criteria = BatchKeywordsStoppingCriteria([stop_str], tokenizer, start_len=0)
         output_ids = model.generate(
-            input_ids,
-            images=image_tensor,
-            do_sample=True,
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            do_sample=do_sample,
             temperature=0.01,
             top_p=0.01,
-            max_new_tokens=1024,
+            max_new_tokens=max_new_tokens,
             use_cache=True,
+            pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
             stopping_criteria=[stopping_criteria])
 
-    outputs = tokenizer.decode(output_ids[0, input_ids.shape[1]:]).strip().replace('</s>', '')
-    return outputs
+    captions = []
+    for output in tokenizer.batch_decode(output_ids, skip_special_tokens=True):
+        output = output.strip()
+        if stop_str and stop_str in output:
+            output = output[:output.index(stop_str)]
+        captions.append(output.strip())
+    return captions
+
+
+def get_caption_tasks(args):
+    """
+    :return: list of (image-text list, output caption json, image_id -> captioning instruction)
+    """
+    if args.cir_data == 'fiq':
+        type2itlist = get_fiq_it()
+        all_it_list = []
+        id2prompt = dict()
+        for dress_type in args.dress_type.split(','):
+            it_list = type2itlist[dress_type]
+            for it in it_list:
+                id2prompt[it['image_id']] = f'please briefly describe the {dress_type} in {args.k} words'
+            all_it_list.extend(it_list)
+        return [(all_it_list, f"mm_data/fiq/fashioniq_it_llava_{args.k}.json", id2prompt)]
+    if args.cir_data == 'cirr':
+        it_list = get_cirr_it()
+        output_path = f"mm_data/cirr/cirr_it_llava_{args.k}.json"
+    else:
+        it_list = get_cc_it(args.cc_id)
+        output_path = f"mm_data/zs/cc_it_{args.cc_id}_llava_{args.k}.json"
+    return [(it_list, output_path, {it['image_id']: f'please briefly describe the image in {args.k} words'
+                                    for it in it_list})]
 
 
 def main(args, image=None):
@@ -124,7 +261,7 @@ if __name__ == "__main__":
     parser.add_argument("--num-gpus", type=int, default=1)
     parser.add_argument("--conv-mode", type=str, default=None)
     parser.add_argument("--temperature", type=float, default=0.2)
-    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--max-new-tokens", type=int, default=None)
     parser.add_argument("--load-8bit", action="store_true")
     parser.add_argument("--load-4bit", action="store_true")
     parser.add_argument("--debug", action="store_true")
@@ -132,8 +269,20 @@ if __name__ == "__main__":
     parser.add_argument("--cir_data", default="fiq")
     parser.add_argument("--cc_id", type=int, default=0)
     parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--num_shards", type=int, default=1)
+    parser.add_argument("--shard_id", type=int, default=-1, help="-1 runs all shards and merges them")
+    parser.add_argument("--gpus", default=None, help="comma separated gpu ids for the shard workers")
+    parser.add_argument("--flush_every", type=int, default=64)
     args = parser.parse_args()
 
+    if args.shard_id < 0 and args.num_shards > 1:
+        # caption every shard in its own worker process, then merge the shards
+        launch_shards(args.num_shards, args.gpus.split(',') if args.gpus else None)
+        for it_list, output_path, _ in get_caption_tasks(args):
+            merge_shards(it_list, output_path, args.num_shards)
+        sys.exit(0)
+
     # 读入图片
     # img1 = '/root_path/fashionIQ_dataset/images/B0083I6W08.png'
     # img2 = '/root_path/fashionIQ_dataset/images/B00BPD4N5E.png'
@@ -170,36 +319,14 @@ if __name__ == "__main__":
     else:
         roles = conv.roles
     # main(args)
-    if args.cir_data == 'fiq':
-        type2itlist = get_fiq_it()
-        dress_types = args.dress_type.split(',')
-        all_it_list = []
-        for dress_type in dress_types:
-            it_list = type2itlist[dress_type]
-            prompt = f'please briefly describe the {dress_type} in {args.k} words'
-            for it in tqdm(it_list):
-                args.image_file = it['image_path']
-                it['caption'] = generate_caption(args, prompt)
-                # print(it['caption'])
-                conv = conv_templates[args.conv_mode].copy()
-            all_it_list.extend(it_list)
-        with open(f"mm_data/fiq/fashioniq_it_llava_{args.k}.json", 'w', encoding='utf-8') as f:
-            f.write(json.dumps(all_it_list, ensure_ascii=False))
-    elif args.cir_data == 'cirr':
-        it_list = get_cirr_it()
-        prompt = f'please briefly describe the image in {args.k} words'
-        for it in tqdm(it_list):
-            args.image_file = it['image_path']
-            it['caption'] = generate_caption(args, prompt)
-            conv = conv_templates[args.conv_mode].copy()
-        with open(f"mm_data/cirr/cirr_it_llava_{args.k}.json", 'w', encoding='utf-8') as f:
-            f.write(json.dumps(it_list, ensure_ascii=False))
-    elif args.cir_data == 'cc':
-        it_list = get_cc_it(args.cc_id)
-        prompt = f'please briefly describe the image in {args.k} words'
-        for it in tqdm(it_list):
-            args.image_file = it['image_path']
-            it['caption'] = generate_caption(args, prompt)
-            conv = conv_templates[args.conv_mode].copy()
-        with open(f"mm_data/zs/cc_it_{args.cc_id}_llava_{args.k}.json", 'w', encoding='utf-8') as f:
-            f.write(json.dumps(it_list, ensure_ascii=False))
\ No newline at end of file
+    prompt_cache = CaptionPromptCache(model, tokenizer, args.conv_mode)
+    max_new_tokens = args.max_new_tokens if args.max_new_tokens is not None else caption_max_new_tokens(args.k)
+    for it_list, output_path, id2prompt in get_caption_tasks(args):
+        def caption_batch(batch):
+            return generate_captions([it['image_path'] for it in batch], [id2prompt[it['image_id']] for it in batch],
+                                     model, tokenizer, image_processor, prompt_cache, max_new_tokens=max_new_tokens)
+
+        run_caption_job(it_list, batched_caption_fn(caption_batch, args.batch_size), output_path,
+                        max(args.shard_id, 0), args.num_shards, args.flush_every)
+        if args.shard_id < 0:
+            merge_shards(it_list, output_path, args.num_shards)
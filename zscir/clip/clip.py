@@ -24,7 +24,7 @@ if packaging.version.parse(torch.__version__) < packaging.version.parse("1.7.1")
     warnings.warn("PyTorch version 1.7.1 or higher is recommended")
 
 __all__ = ["available_models", "load", "tokenize"]
-_tokenizer = _Tokenizer()
+_tokenizer = None
 
 _MODELS = {
     "RN50": "https://openaipublic.azureedge.net/clip/models/afeb0e10f9e5a86da6080e35cf09123aca3b358a0c3e3b6c78a7b63bc04b6762/RN50.pt",
@@ -39,6 +39,44 @@ _MODELS = {
 }
 
 
+def _sha256(path: str, chunk_size: int = 1 << 20):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _digest_record(path: str, sha256: str):
+    stat = os.stat(path)
+    return f"{stat.st_size} {stat.st_mtime_ns} {sha256}"
+
+
+def _write_digest_record(path: str, sha256: str):
+    try:
+        with open(path + ".sha256", "w") as f:
+            f.write(_digest_record(path, sha256))
+    except OSError:
+        pass
+
+
+def _verify_sha256(path: str, expected_sha256: str):
+    """
+    Whether the file has the expected SHA256. The digest of a verified file is recorded in a path.sha256 sidecar
+    keyed on its size and mtime, so that an unchanged file is not hashed again on the next load
+    """
+    try:
+        with open(path + ".sha256") as f:
+            if f.read().strip() == _digest_record(path, expected_sha256):
+                return True
+    except OSError:
+        pass
+    if _sha256(path) != expected_sha256:
+        return False
+    _write_digest_record(path, expected_sha256)
+    return True
+
+
 def _download(url: str, root: str):
     os.makedirs(root, exist_ok=True)
     filename = os.path.basename(url)
@@ -50,11 +88,12 @@ def _download(url: str, root: str):
         raise RuntimeError(f"{download_target} exists and is not a regular file")
 
     if os.path.isfile(download_target):
-        if hashlib.sha256(open(download_target, "rb").read()).hexdigest() == expected_sha256:
+        if _verify_sha256(download_target, expected_sha256):
             return download_target
         else:
             warnings.warn(f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file")
 
+    sha256 = hashlib.sha256()
     with urllib.request.urlopen(url) as source, open(download_target, "wb") as output:
         with tqdm(total=int(source.info().get("Content-Length")), ncols=80, unit='iB', unit_scale=True,
                   unit_divisor=1024) as loop:
@@ -64,10 +103,12 @@ def _download(url: str, root: str):
                     break
 
                 output.write(buffer)
+                sha256.update(buffer)
                 loop.update(len(buffer))
 
-    if hashlib.sha256(open(download_target, "rb").read()).hexdigest() != expected_sha256:
+    if sha256.hexdigest() != expected_sha256:
         raise RuntimeError("Model has been downloaded but the SHA256 checksum does not not match")
+    _write_digest_record(download_target, expected_sha256)
 
     return download_target
 
@@ -203,8 +244,18 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     return model, _transform(model.input_resolution.item())
 
 
-def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: bool = False) -> Union[
-    torch.IntTensor, torch.LongTensor]:
+def _get_tokenizer():
+    """
+    Build the BPE tokenizer on first use, so that importing clip (e.g. in every DataLoader worker) stays cheap
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = _Tokenizer()
+    return _tokenizer
+
+
+def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: bool = False,
+             num_workers: int = 0) -> Union[torch.IntTensor, torch.LongTensor]:
     """
     Returns the tokenized representation of given input string(s)
 
@@ -219,6 +270,9 @@ def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: b
     truncate: bool
         Whether to truncate the text in case its encoding is longer than the context length
 
+    num_workers: int
+        Number of threads encoding the distinct strings of a large batch, 0 to encode them in the calling thread
+
     Returns
     -------
     A two-dimensional tensor containing the resulting tokens, shape = [number of input strings, context_length].
@@ -227,21 +281,33 @@ def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: b
     if isinstance(texts, str):
         texts = [texts]
 
-    sot_token = _tokenizer.encoder["<|startoftext|>"]
-    eot_token = _tokenizer.encoder["<|endoftext|>"]
-    all_tokens = [[sot_token] + _tokenizer.encode(text) + [eot_token] for text in texts]
+    tokenizer = _get_tokenizer()
+    sot_token = tokenizer.encoder["<|startoftext|>"]
+    eot_token = tokenizer.encoder["<|endoftext|>"]
+    # captions repeat a lot within a batch, only the distinct ones are encoded and padded
+    unique_texts = list(dict.fromkeys(texts))
+    all_tokens = [[sot_token] + tokens + [eot_token] for tokens in tokenizer.encode_batch(unique_texts, num_workers)]
     if packaging.version.parse(torch.__version__) < packaging.version.parse("1.8.0"):
-        result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
+        dtype = torch.long
     else:
-        result = torch.zeros(len(all_tokens), context_length, dtype=torch.int)
+        dtype = torch.int
 
     for i, tokens in enumerate(all_tokens):
         if len(tokens) > context_length:
             if truncate:
                 tokens = tokens[:context_length]
                 tokens[-1] = eot_token
+                all_tokens[i] = tokens
             else:
-                raise RuntimeError(f"Input {texts[i]} is too long for context length {context_length}")
-        result[i, :len(tokens)] = torch.tensor(tokens)
+                raise RuntimeError(f"Input {unique_texts[i]} is too long for context length {context_length}")
+
+    # scatter all token lists at once into the left of their rows
+    lengths = torch.tensor([len(tokens) for tokens in all_tokens], dtype=torch.long)
+    result = torch.zeros(len(all_tokens), context_length, dtype=dtype)
+    result[torch.arange(context_length) < lengths.unsqueeze(1)] = torch.tensor(
+        [token for tokens in all_tokens for token in tokens], dtype=dtype)
+    if len(unique_texts) < len(texts):
+        unique_index = {text: i for i, text in enumerate(unique_texts)}
+        result = result[torch.tensor([unique_index[text] for text in texts], dtype=torch.long)]
 
     return result
@@ -8,7 +8,7 @@ import clip
 import torch
 from tqdm import tqdm
 from prompts import prompts_reference, prompts_both, prompts_target
-from retrieval import ImageDataset, extract_image_features
+from retrieval import ImageDataset, load_or_extract_image_features, topk_search
 
 
 def get_fiq_it():
@@ -134,12 +134,11 @@ def get_triplets(it_list):
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
         clip_model, clip_preprocess = clip.load("ViT-B/16", device=device, jit=False)
         query_image_dataset = ImageDataset(it_list, clip_preprocess)
-        query_image_features, query_image_paths = extract_image_features(clip_model, query_image_dataset, device)
-        target_image_features, target_image_paths = query_image_features, query_image_paths
-        distances = query_image_features @ target_image_features.T  # bs*dim @ dim*num = bs*num
-        sorted_indices = torch.argsort(distances, dim=-1, descending=True).cpu()[:, :args.topk + 1]
+        query_image_features, query_image_paths = load_or_extract_image_features(clip_model, query_image_dataset,
+                                                                                 device, args.feature_cache)
+        # the reference itself is excluded from its neighbours
+        _, sorted_indices = topk_search(query_image_features, query_image_features, args.topk, exclude_self=True)
         for i, sorted_indice in enumerate(sorted_indices):
-            sorted_indice = sorted_indice[sorted_indice != i][:args.topk]  # remove reference
             for j in sorted_indice:
                 triplet = get_triplet(prompts_both[0], it_list[i], it_list[j])
                 triplets.append(triplet)
@@ -151,7 +150,8 @@ if __name__ == '__main__':
     parser.add_argument("--dataset", choices=['coco', 'fiq'])
     parser.add_argument("--seed", default=42)
     parser.add_argument("--method", default='baseline', choices=['baseline', 'multip', 'mostsim'])
-    parser.add_argument("--topk", default=2)
+    parser.add_argument("--topk", default=2, type=int)
+    parser.add_argument("--feature_cache", default=None, help="file to persist the image features in")
     args = parser.parse_args()
     if args.dataset == 'coco':
         process_coco()
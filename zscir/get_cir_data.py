@@ -6,7 +6,42 @@ import torch
 
 from data_utils_gen import CIRDataset, targetpad_transform
 from tqdm import tqdm
-import clip
+from clip.simple_tokenizer import SimpleTokenizer
+
+
+class CaptionLengthValidator:
+    """
+    Memoized CLIP BPE token counter used to check generated captions against the context length
+    """
+
+    def __init__(self, context_length: int = 77):
+        self.tokenizer = SimpleTokenizer()
+        self.context_length = context_length
+        self.sot_token = self.tokenizer.encoder["<|startoftext|>"]
+        self.eot_token = self.tokenizer.encoder["<|endoftext|>"]
+        self.cache = dict()
+
+    def encode(self, caption):
+        """
+        :param caption: caption string
+        :return: token ids (with start and end tokens, unpadded) of the caption
+        """
+        if caption not in self.cache:
+            self.cache[caption] = [self.sot_token] + self.tokenizer.encode(caption) + [self.eot_token]
+        return self.cache[caption]
+
+    def encode_batch(self, captions):
+        """
+        Encode a list of captions, running BPE only once per unique caption
+        :param captions: list of caption strings
+        :return: list of token id lists aligned with captions
+        """
+        for caption in dict.fromkeys(captions):
+            self.encode(caption)
+        return [self.cache[caption] for caption in captions]
+
+    def is_valid(self, caption):
+        return len(self.encode(caption)) <= self.context_length
 
 
 def get_captions(caption1, caption2):
@@ -15,15 +50,11 @@ def get_captions(caption1, caption2):
         "Unlike {0}, I want {1}",
         "{1}"
     ]
-    captions = []
-    for prompt_id in prompt_ids:
-        caption = prompt_list[prompt_id].format(caption1, caption2)
-        try:
-            clip.tokenize(caption)
-        except:
-            caption = caption2
-        captions.append(caption)
-    return captions
+    captions = [prompt_list[prompt_id].format(caption1, caption2) for prompt_id in prompt_ids]
+    all_tokens = validator.encode_batch(captions)
+    captions = [caption if len(tokens) <= validator.context_length else caption2
+                for caption, tokens in zip(captions, all_tokens)]
+    return captions, validator.encode_batch(captions)
 
 
 def get_fiq():
@@ -76,12 +107,13 @@ def get_fiq():
             name2 = relative_train_dataset.imagenames[idx]
             caption1 = name2caption[name1]
             caption2 = name2caption[name2]
-            caption = get_captions(caption1, caption2)
+            caption, caption_tokens = get_captions(caption1, caption2)
             # caption = "{} instead of {}".format(caption2, caption1)
             triplet = {
                 "target": name2,
                 "candidate": name1,
                 "captions": caption,
+                "caption_tokens": caption_tokens,
                 "caption1": caption1,
                 "caption2": caption2,
             }
@@ -90,9 +122,10 @@ def get_fiq():
         extend_triplets = random.sample(extend_triplets, args.K)
     N = len(extend_triplets)
     if args.use_llm:
-        for triplet in tqdm(extend_triplets):
-            llm_caption = generate_modified_text(triplet['caption1'], triplet['caption2'], mod_type=1, data='fiq',
-                                                 llm_type=args.use_llm)
+        llm_captions = generate_modified_texts([(triplet['caption1'], triplet['caption2']) for triplet in extend_triplets],
+                                               data='fiq', mod_type=1, llm_type=args.use_llm,
+                                               batch_size=args.llm_batch_size, cache=RewriteCache(args.llm_cache))
+        for triplet, llm_caption in zip(extend_triplets, llm_captions):
             triplet['llm_caption'] = llm_caption
     print(len(extend_triplets))
     llm_cap = "_llm" if args.use_llm else ""
@@ -150,11 +183,12 @@ def get_cirr():
             name2 = relative_train_dataset.imagenames[idx]
             caption1 = name2caption[name1]
             caption2 = name2caption[name2]
-            caption = get_captions(caption1, caption2)
+            caption, caption_tokens = get_captions(caption1, caption2)
             triplet = {
                 "target_hard": name2,
                 "reference": name1,
                 "caption": caption,
+                "caption_tokens": caption_tokens,
                 "pairid": 0,
                 "img_set": {"members": ["xxx"]},
                 "caption1": caption1,
@@ -165,9 +199,10 @@ def get_cirr():
         extend_triplets = random.sample(extend_triplets, args.K)
     N = len(extend_triplets)
     if args.use_llm:
-        for triplet in tqdm(extend_triplets):
-            llm_caption = generate_modified_text(triplet['caption1'], triplet['caption2'], data='cirr', mod_type=0,
-                                                 llm_type=args.use_llm)
+        llm_captions = generate_modified_texts([(triplet['caption1'], triplet['caption2']) for triplet in extend_triplets],
+                                               data='cirr', mod_type=0, llm_type=args.use_llm,
+                                               batch_size=args.llm_batch_size, cache=RewriteCache(args.llm_cache))
+        for triplet, llm_caption in zip(extend_triplets, llm_captions):
             triplet['llm_caption'] = llm_caption
     print(len(extend_triplets))
     llm_cap = "_llm" if args.use_llm else ""
@@ -205,12 +240,14 @@ def get_cc():
     for i, it in tqdm(enumerate(it_list)):
         id_list = get_diff_id(i, N, args.k)
         for j in id_list:
+            captions, caption_tokens = get_captions(it_list[i]['caption'], it_list[j]['caption'])
             triplets.append({
                 "target": it_list[j]['image_path'],
                 "reference": it_list[i]['image_path'],
                 "reference_name": it_list[i]['image_id'],
                 "target_name": it_list[j]['image_id'],
-                "captions": get_captions(it_list[i]['caption'], it_list[j]['caption']),
+                "captions": captions,
+                "caption_tokens": caption_tokens,
             })
     flag_2 = "2" if "2" in args.data else ""
     if 'fiq' in args.data:
@@ -235,13 +272,21 @@ if __name__ == '__main__':
     parser.add_argument("--i2i_rank", default=-1, type=int)
     parser.add_argument("--i2i_rank_max", default=-1, type=int)
     parser.add_argument("--use_llm", default=0, type=int)
+    parser.add_argument("--llm_batch_size", default=16, type=int)
+    parser.add_argument("--llm_cache", default="mm_data/llm_rewrite_cache.jsonl")
+    parser.add_argument("--llm_path", default="/root_path/LLM/llama2/llama2-7b-chat")
+    parser.add_argument("--llm_device", default="auto", help="auto, cpu or a cuda device")
     parser.add_argument("--p_list", default='0,1')
     parser.add_argument("--mllm", default='llava', choices=['blip', 'blip2', 'llava'])
     parser.add_argument("--word_num", default=10, type=int)
     args = parser.parse_args()
     if args.use_llm:
-        from llama_generate import generate_modified_text
+        from llama_generate import generate_modified_texts, RewriteCache, get_generator
+
+        # the model itself is only loaded if some prompt is missing from the cache
+        get_generator(model_path=args.llm_path, device=args.llm_device)
     random.seed(args.seed)
+    validator = CaptionLengthValidator()
     prompt_ids = list(map(int, args.p_list.split(",")))
     if args.data == 'fiq':
         get_fiq()
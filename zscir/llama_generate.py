@@ -21,27 +21,144 @@ import json
 from prompt import prompt_templates, get_prompt
 
 import argparse
+import hashlib
+import os
 
 import torch
-import transformers
-from transformers import AutoModelForCausalLM, AutoTokenizer
-
-model: AutoModelForCausalLM = AutoModelForCausalLM.from_pretrained("/root_path/LLM/llama2/llama2-7b-chat",
-                                                                   device_map="auto",
-                                                                   torch_dtype=torch.float16)
-tokenizer = AutoTokenizer.from_pretrained("/root_path/LLM/llama2/llama2-7b-chat")
-tokenizer.use_default_system_prompt = False
-pipeline = transformers.pipeline(
-    "text-generation",
-    model=model,
-    tokenizer=tokenizer,
-    torch_dtype=torch.float16,
-    device_map="auto",
-)
-print("model load successfully")
-gpu_mem = torch.cuda.get_device_properties(0).total_memory
-available_mem = gpu_mem - torch.cuda.memory_allocated(0)
-print('Total memory:', gpu_mem, 'Available memory:', available_mem)
+from tqdm import tqdm
+
+default_model_path = "/root_path/LLM/llama2/llama2-7b-chat"
+default_cache_path = "mm_data/llm_rewrite_cache.jsonl"
+
+
+class LlamaGenerator:
+    """
+    Llama-2 chat model used to rewrite modified texts, loaded on first use and reused across calls
+    :param model_path: local path or hub id of the causal LM
+    :param torch_dtype: dtype of the weights, defaults to fp16 on GPU and fp32 on CPU
+    :param device: "auto" to dispatch over the available GPUs, or a device such as "cpu" / "cuda:0"
+    """
+
+    def __init__(self, model_path=default_model_path, torch_dtype=None, device="auto"):
+        self.model_path = model_path
+        self.device = device
+        if torch_dtype is None:
+            torch_dtype = torch.float16 if torch.cuda.is_available() and device != "cpu" else torch.float32
+        self.torch_dtype = torch_dtype
+        self._model = None
+        self._tokenizer = None
+        self._pipeline = None
+
+    def load(self):
+        if self._model is not None:
+            return
+        # transformers itself is heavy to import, so it is only imported with the model
+        import transformers
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        if self.device == "auto":
+            model = AutoModelForCausalLM.from_pretrained(self.model_path, device_map="auto",
+                                                         torch_dtype=self.torch_dtype)
+        else:
+            model = AutoModelForCausalLM.from_pretrained(self.model_path, torch_dtype=self.torch_dtype)
+            model = model.to(self.device)
+        tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+        tokenizer.use_default_system_prompt = False
+        self._pipeline = transformers.pipeline(
+            "text-generation",
+            model=model,
+            tokenizer=tokenizer,
+            torch_dtype=self.torch_dtype,
+        )
+        self._model = model.eval()
+        self._tokenizer = tokenizer
+        print("model load successfully")
+        if model.device.type == 'cuda':
+            gpu_mem = torch.cuda.get_device_properties(model.device).total_memory
+            available_mem = gpu_mem - torch.cuda.memory_allocated(model.device)
+            print('Total memory:', gpu_mem, 'Available memory:', available_mem)
+
+    @property
+    def model(self):
+        self.load()
+        return self._model
+
+    @property
+    def tokenizer(self):
+        self.load()
+        return self._tokenizer
+
+    @property
+    def pipeline(self):
+        self.load()
+        return self._pipeline
+
+    def generate(self, prompt, max_new_tokens=25, post=True):
+        sequences = self.pipeline(
+            prompt,
+            do_sample=True,
+            top_k=10,
+            num_return_sequences=1,
+            eos_token_id=self.tokenizer.eos_token_id,
+            pad_token_id=self.tokenizer.eos_token_id,
+            max_new_tokens=max_new_tokens,
+        )
+        N = len(prompt)
+        res = sequences[0]['generated_text'][N:]
+        # print(res)
+        if post:
+            res = post_process(res)
+        return res
+
+    def generate_batch(self, prompts, max_new_tokens=25, batch_size=16, post=True, cache=None):
+        """
+        Generate an output for every prompt, running each unique prompt only once in left-padded batches
+        :param cache: RewriteCache consulted before and filled after generation
+        :return: list of outputs aligned with prompts
+        """
+        cache = cache if cache is not None else RewriteCache(None)
+        prompt2key = {prompt: RewriteCache.key(prompt, max_new_tokens, self.model_path)
+                      for prompt in dict.fromkeys(prompts)}
+        todo = [prompt for prompt, key in prompt2key.items() if cache.get(key) is None]
+        print(f"{len(prompts)} prompts, {len(prompt2key)} unique, {len(todo)} to generate", flush=True)
+        if len(todo) > 0:
+            tokenizer = self.tokenizer
+            tokenizer.padding_side = 'left'
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+        for i in tqdm(range(0, len(todo), batch_size)):
+            batch = todo[i:i + batch_size]
+            inputs = tokenizer(batch, return_tensors='pt', padding=True).to(self.model.device)
+            with torch.no_grad():
+                output_ids = self.model.generate(
+                    **inputs,
+                    do_sample=True,
+                    top_k=10,
+                    num_return_sequences=1,
+                    eos_token_id=tokenizer.eos_token_id,
+                    pad_token_id=tokenizer.pad_token_id,
+                    max_new_tokens=max_new_tokens,
+                )
+            outputs = tokenizer.batch_decode(output_ids[:, inputs['input_ids'].shape[1]:], skip_special_tokens=True)
+            # outputs are cached unprocessed so that post-processing can change without regenerating
+            cache.update({prompt2key[prompt]: output for prompt, output in zip(batch, outputs)})
+        outputs = [cache.get(prompt2key[prompt]) for prompt in prompts]
+        return [post_process(output) for output in outputs] if post else outputs
+
+
+_generator = None
+
+
+def get_generator(model_path=None, torch_dtype=None, device=None):
+    """
+    :return: the shared LlamaGenerator, created on the first call; passing any argument replaces it with a new
+        generator built from those settings
+    """
+    global _generator
+    if _generator is None or model_path is not None or torch_dtype is not None or device is not None:
+        _generator = LlamaGenerator(model_path if model_path is not None else default_model_path, torch_dtype,
+                                    device if device is not None else "auto")
+    return _generator
 
 
 def post_process(output):
@@ -53,28 +170,18 @@ def post_process(output):
 
 
 def generate(prompt, max_new_tokens=25, post=True):
-    sequences = pipeline(
-        prompt,
-        do_sample=True,
-        top_k=10,
-        num_return_sequences=1,
-        eos_token_id=tokenizer.eos_token_id,
-        pad_token_id=tokenizer.eos_token_id,
-        max_new_tokens=max_new_tokens,
-    )
-    N = len(prompt)
-    res = sequences[0]['generated_text'][N:]
-    # print(res)
-    if post:
-        res = post_process(res)
-    return res
+    return get_generator().generate(prompt, max_new_tokens=max_new_tokens, post=post)
 
 
-def generate_modified_text(caption1="The toptee is a black, sleeveless, heart-shaped top.",
-                           caption2="The toptee is a green, long-sleeved, and loose-fitting shirt.",
-                           data='cirr',
-                           mod_type=0,
-                           llm_type=1):
+def generate_batch(prompts, max_new_tokens=25, batch_size=16, post=True, cache=None):
+    return get_generator().generate_batch(prompts, max_new_tokens=max_new_tokens, batch_size=batch_size, post=post,
+                                          cache=cache)
+
+
+def build_modified_text_prompt(caption1, caption2, data='cirr', mod_type=0, llm_type=1):
+    """
+    :return: LLM prompt rewriting the modified text of a caption pair and its generation budget
+    """
     prompt_template = prompt_templates[data]
     if mod_type == 0:
         if caption1[-1] == '.':
@@ -91,11 +198,70 @@ def generate_modified_text(caption1="The toptee is a black, sleeveless, heart-sh
     else:
         prompt = prompt_template.format(old_text)
     max_new_tokens = 25 if data == 'fiq' else 50
+    return prompt, max_new_tokens
+
+
+def generate_modified_text(caption1="The toptee is a black, sleeveless, heart-shaped top.",
+                           caption2="The toptee is a green, long-sleeved, and loose-fitting shirt.",
+                           data='cirr',
+                           mod_type=0,
+                           llm_type=1):
+    prompt, max_new_tokens = build_modified_text_prompt(caption1, caption2, data, mod_type, llm_type)
     text = generate(prompt, max_new_tokens=max_new_tokens)
     print(text, flush=True)
     return text
 
 
+class RewriteCache:
+    """
+    On-disk prompt-hash -> LLM output cache (append-only JSONL), shared by re-runs and datasets
+    """
+
+    def __init__(self, path=default_cache_path):
+        self.path = path
+        self.hash2output = dict()
+        if path is not None and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.hash2output[record['hash']] = record['output']
+
+    @staticmethod
+    def key(prompt, max_new_tokens, model_path=default_model_path):
+        return hashlib.sha256(f"{model_path}\n{max_new_tokens}\n{prompt}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        return self.hash2output.get(key)
+
+    def update(self, key2output):
+        self.hash2output.update(key2output)
+        if self.path is None or len(key2output) == 0:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for key, output in key2output.items():
+                f.write(json.dumps({"hash": key, "output": output}, ensure_ascii=False) + '\n')
+
+
+def generate_modified_texts(caption_pairs, data='cirr', mod_type=0, llm_type=1, batch_size=16, cache=None):
+    """
+    Batched generate_modified_text
+    :param caption_pairs: list of (caption1, caption2)
+    :return: list of modified texts aligned with caption_pairs
+    """
+    prompts = []
+    max_new_tokens = None
+    for caption1, caption2 in caption_pairs:
+        prompt, max_new_tokens = build_modified_text_prompt(caption1, caption2, data, mod_type, llm_type)
+        prompts.append(prompt)
+    if len(prompts) == 0:
+        return []
+    return generate_batch(prompts, max_new_tokens=max_new_tokens, batch_size=batch_size, cache=cache)
+
+
 def get_triplets():
     generate_modified_text(args.data)
 
@@ -72,3 +72,38 @@ class KeywordsStoppingCriteria(StoppingCriteria):
             if keyword in outputs:
                 return True
         return False
+
+
+class BatchKeywordsStoppingCriteria(StoppingCriteria):
+    """
+    Keyword stopping criteria for batched generation: every sequence is stopped on its own once it ends
+    with one of the keywords, generation stops when all sequences are done
+    """
+
+    def __init__(self, keywords, tokenizer, start_len=0):
+        self.keywords = keywords
+        self.keyword_ids = []
+        for keyword in keywords:
+            cur_keyword_ids = tokenizer(keyword).input_ids
+            if len(cur_keyword_ids) > 1 and cur_keyword_ids[0] == tokenizer.bos_token_id:
+                cur_keyword_ids = cur_keyword_ids[1:]
+            self.keyword_ids.append(torch.tensor(cur_keyword_ids))
+        self.tokenizer = tokenizer
+        self.start_len = start_len
+        self.done = None
+
+    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.done is None or self.done.shape[0] != output_ids.shape[0]:
+            self.done = torch.zeros(output_ids.shape[0], dtype=torch.bool, device=output_ids.device)
+        offset = min(output_ids.shape[1] - self.start_len, 3)
+        if offset <= 0:
+            return self.done.clone()
+        self.keyword_ids = [keyword_id.to(output_ids.device) for keyword_id in self.keyword_ids]
+        for keyword_id in self.keyword_ids:
+            if output_ids.shape[1] >= keyword_id.shape[0]:
+                self.done |= (output_ids[:, -keyword_id.shape[0]:] == keyword_id).all(dim=1)
+        outputs = self.tokenizer.batch_decode(output_ids[:, -offset:], skip_special_tokens=True)
+        for i, output in enumerate(outputs):
+            if not self.done[i] and any(keyword in output for keyword in self.keywords):
+                self.done[i] = True
+        return self.done.clone()
@@ -4,6 +4,7 @@ import multiprocessing
 import os.path
 from pathlib import Path
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, List
 
 import torch
@@ -76,6 +77,135 @@ def extract_image_features(cmr_model, imageDataset: ImageDataset, device):
     return image_features, image_paths
 
 
+def load_or_extract_image_features(cmr_model, imageDataset: ImageDataset, device, cache_path=None):
+    """
+    extract_image_features, persisting the features to cache_path so later runs over the same images reuse them
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        cache = torch.load(cache_path, map_location='cpu')
+        path2index = {path: i for i, path in enumerate(cache['image_paths'])}
+        if all(path in path2index for path in imageDataset.image_path_list):
+            print(f"load image features from {cache_path}")
+            index = torch.tensor([path2index[path] for path in imageDataset.image_path_list], dtype=torch.long)
+            return cache['image_features'][index].to(device), list(imageDataset.image_path_list)
+        print(f"{cache_path} does not cover all images, re-extracting")
+    image_features, image_paths = extract_image_features(cmr_model, imageDataset, device)
+    if cache_path is not None and image_paths == imageDataset.image_path_list:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        torch.save({'image_features': image_features.cpu(), 'image_paths': image_paths}, cache_path)
+    return image_features, image_paths
+
+
+@torch.no_grad()
+def topk_search(query_features, gallery_features, topk, exclude_self=False, query_block=1024, gallery_block=32768):
+    """
+    Exact blocked top-k inner-product search that never materializes the full query x gallery similarity matrix
+    :param query_features: tensor of shape [Nq, dim], its device is used for the computation
+    :param gallery_features: tensor of shape [Ng, dim], may stay on cpu (blocks are moved to the query device)
+    :param topk: number of neighbours per query
+    :param exclude_self: skip gallery index i for query i (query and gallery are the same pool)
+    :return: scores and indices of shape [Nq, topk] on cpu, sorted by descending similarity
+    """
+    device = query_features.device
+    num_query, num_gallery = query_features.shape[0], gallery_features.shape[0]
+    topk = min(topk, num_gallery - 1 if exclude_self else num_gallery)
+    all_scores = torch.empty(num_query, topk, dtype=torch.float)
+    all_indices = torch.empty(num_query, topk, dtype=torch.long)
+    for q_start in range(0, num_query, query_block):
+        queries = query_features[q_start:q_start + query_block]
+        query_ids = torch.arange(q_start, q_start + queries.shape[0], device=device)
+        best_scores = torch.full((queries.shape[0], topk), float('-inf'), device=device)
+        best_indices = torch.zeros((queries.shape[0], topk), dtype=torch.long, device=device)
+        for g_start in range(0, num_gallery, gallery_block):
+            gallery = gallery_features[g_start:g_start + gallery_block].to(device, non_blocking=True)
+            scores = (queries @ gallery.T).float()
+            gallery_ids = torch.arange(g_start, g_start + gallery.shape[0], device=device)
+            if exclude_self:
+                scores.masked_fill_(query_ids[:, None] == gallery_ids[None, :], float('-inf'))
+            block_k = min(topk, gallery.shape[0])
+            block_scores, block_indices = scores.topk(block_k, dim=-1)
+            merged_scores = torch.cat([best_scores, block_scores], dim=-1)
+            merged_indices = torch.cat([best_indices, gallery_ids[block_indices]], dim=-1)
+            best_scores, order = merged_scores.topk(topk, dim=-1)
+            best_indices = merged_indices.gather(-1, order)
+        all_scores[q_start:q_start + queries.shape[0]] = best_scores.cpu()
+        all_indices[q_start:q_start + queries.shape[0]] = best_indices.cpu()
+    return all_scores, all_indices
+
+
+def link_or_copy(src, dst, mode='link'):
+    """
+    Place src at dst as a hardlink, falling back to a symlink and then to a copy
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode == 'link':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return
+        except OSError:
+            pass
+    shutil.copy(src, dst)
+
+
+def write_manifest(output, results):
+    """
+    Write the retrieval results as manifest.json and a browsable index.html referencing the original images
+    """
+    with open(os.path.join(output, 'manifest.json'), 'w', encoding='utf-8') as f:
+        f.write(json.dumps(results, ensure_ascii=False))
+    rows = []
+    for result in results:
+        cells = [f'<td><img src="{Path(result["query"]).absolute().as_uri()}" height="128"><br>query {result["id"]}</td>']
+        for target in result['targets']:
+            cells.append(f'<td><img src="{Path(target["path"]).absolute().as_uri()}" height="128"><br>'
+                         f'{target["rank"]}: {target["score"]:.3f}</td>')
+        rows.append('<tr>' + ''.join(cells) + '</tr>')
+    with open(os.path.join(output, 'index.html'), 'w', encoding='utf-8') as f:
+        f.write('<html><body><table>\n' + '\n'.join(rows) + '\n</table></body></html>')
+
+
+def export_retrieval_results(output, query_image_paths, target_image_paths, sorted_indices, scores, mode='link',
+                             num_threads=16):
+    """
+    Export the top-k targets of every query under output/{query id}/, plus a manifest of all results
+    :param mode: 'link', 'copy' or 'manifest' (no per-query folders, only the manifest)
+    """
+    os.makedirs(output, exist_ok=True)
+    results = []
+    for i, (sorted_indice, score) in enumerate(zip(sorted_indices.tolist(), scores.tolist())):
+        results.append({
+            "id": i,
+            "query": query_image_paths[i],
+            "targets": [{"rank": rank, "index": j, "path": target_image_paths[j], "score": s}
+                        for rank, (j, s) in enumerate(zip(sorted_indice, score))],
+        })
+    write_manifest(output, results)
+    if mode == 'manifest':
+        return
+
+    def export_one(result):
+        out_path = os.path.join(output, f'{result["id"]}')
+        os.makedirs(out_path, exist_ok=True)
+        files = {'query.png': result['query']}
+        for target in result['targets']:
+            files[f'target_{target["rank"]}_{target["index"]}.png'] = target['path']
+        # remove what an earlier export left behind instead of recreating the folder
+        for name in os.listdir(out_path):
+            if name not in files:
+                os.remove(os.path.join(out_path, name))
+        for name, src in files.items():
+            link_or_copy(src, os.path.join(out_path, name), mode)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(tqdm(executor.map(export_one, results), total=len(results), desc='移动文件到输出文件夹中'))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--query_image_path", default='')
@@ -84,31 +214,29 @@ if __name__ == '__main__':
     parser.add_argument("--topk", default=20, type=int)
     parser.add_argument("--save", action='store_true')
     parser.add_argument("--output", default='test')
+    parser.add_argument("--exclude_self", action='store_true', help="query and target are the same image pool")
+    parser.add_argument("--feature_cache", default=None, help="directory to persist the image features in")
+    parser.add_argument("--export_mode", default='link', choices=['link', 'copy', 'manifest'],
+                        help="link: hardlink (or symlink) the images, copy: copy them, "
+                             "manifest: only write manifest.json/index.html referencing the original images")
+    parser.add_argument("--num_threads", default=16, type=int)
     args = parser.parse_args()
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     clip_model, clip_preprocess = clip.load("ViT-B/16", device=device, jit=False)
     if args.retrieval_type == 'i2i':
         query_image_dataset = ImageDataset(args.query_image_path, clip_preprocess)
         target_image_dataset = ImageDataset(args.target_image_path, clip_preprocess)
-        query_image_features, query_image_paths = extract_image_features(clip_model, query_image_dataset, device)
-        target_image_features, target_image_paths = extract_image_features(clip_model, target_image_dataset, device)
-        distances = query_image_features @ target_image_features.T  # bs*dim @ dim*num = bs*num
-        sorted_indices = torch.argsort(distances, dim=-1, descending=True).cpu()[:, :args.topk]
+        query_cache, target_cache = None, None
+        if args.feature_cache is not None:
+            query_cache = os.path.join(args.feature_cache, 'query_image_features.pt')
+            target_cache = os.path.join(args.feature_cache, 'target_image_features.pt')
+        query_image_features, query_image_paths = load_or_extract_image_features(clip_model, query_image_dataset,
+                                                                                 device, query_cache)
+        target_image_features, target_image_paths = load_or_extract_image_features(clip_model, target_image_dataset,
+                                                                                   device, target_cache)
+        scores, sorted_indices = topk_search(query_image_features, target_image_features, args.topk,
+                                             exclude_self=args.exclude_self)
         if args.save:
-            if not os.path.exists("retrieval_results"):
-                os.mkdir("retrieval_results")
-            args.output = os.path.join("retrieval_results", args.output)
-            if not os.path.exists(args.output):
-                os.mkdir(args.output)
-            for i, sorted_indice in tqdm(enumerate(sorted_indices), desc='移动文件到输出文件夹中'):
-                query_image_path = query_image_paths[i]
-                out_path = os.path.join(args.output, f'{i}')
-                if not os.path.exists(out_path):
-                    os.mkdir(out_path)
-                else:
-                    shutil.rmtree(out_path)
-                    os.mkdir(out_path)
-                shutil.copy(query_image_path, os.path.join(out_path, 'query.png'))
-                for rank, j in enumerate(sorted_indice):
-                    target_image_path = target_image_paths[j]
-                    shutil.copy(target_image_path, os.path.join(out_path, f'target_{rank}_{j}.png'))
+            export_retrieval_results(os.path.join("retrieval_results", args.output), query_image_paths,
+                                     target_image_paths, sorted_indices, scores, mode=args.export_mode,
+                                     num_threads=args.num_threads)
@@ -42,6 +42,44 @@ def rm_module_from_state_dict(state_dict: dict) -> dict:
     return result
 
 
+def _sha256(path: str, chunk_size: int = 1 << 20):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _digest_record(path: str, sha256: str):
+    stat = os.stat(path)
+    return f"{stat.st_size} {stat.st_mtime_ns} {sha256}"
+
+
+def _write_digest_record(path: str, sha256: str):
+    try:
+        with open(path + ".sha256", "w") as f:
+            f.write(_digest_record(path, sha256))
+    except OSError:
+        pass
+
+
+def _verify_sha256(path: str, expected_sha256: str):
+    """
+    Whether the file has the expected SHA256. The digest of a verified file is recorded in a path.sha256 sidecar
+    keyed on its size and mtime, so that an unchanged file is not hashed again on the next load
+    """
+    try:
+        with open(path + ".sha256") as f:
+            if f.read().strip() == _digest_record(path, expected_sha256):
+                return True
+    except OSError:
+        pass
+    if _sha256(path) != expected_sha256:
+        return False
+    _write_digest_record(path, expected_sha256)
+    return True
+
+
 # copy from https://github.com/openai/CLIP/blob/main/clip/clip.py#L43
 def _download(url: str, root: str):
     os.makedirs(root, exist_ok=True)
@@ -55,12 +93,13 @@ def _download(url: str, root: str):
             f"{download_target} exists and is not a regular file")
 
     if os.path.isfile(download_target):
-        if hashlib.sha256(open(download_target, "rb").read()).hexdigest() == expected_sha256:
+        if _verify_sha256(download_target, expected_sha256):
             return download_target
         else:
             warnings.warn(
                 f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file")
 
+    sha256 = hashlib.sha256()
     with urllib.request.urlopen(url) as source, open(download_target, "wb") as output:
         with tqdm(total=int(source.info().get("Content-Length")), ncols=80, unit='iB', unit_scale=True, unit_divisor=1024) as loop:
             while True:
@@ -69,11 +108,13 @@ def _download(url: str, root: str):
                     break
 
                 output.write(buffer)
+                sha256.update(buffer)
                 loop.update(len(buffer))
 
-    if hashlib.sha256(open(download_target, "rb").read()).hexdigest() != expected_sha256:
+    if sha256.hexdigest() != expected_sha256:
         raise RuntimeError(
             "Model has been downloaded but the SHA256 checksum does not not match")
+    _write_digest_record(download_target, expected_sha256)
 
     return download_target
 
@@ -1,4 +1,7 @@
+import copy
 import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import torch
@@ -50,23 +53,146 @@ def extract_index_features(dataset: CIRDataset, model, device=torch.device('cuda
     return index_features, index_names
 
 
-def save_model(name: str, cur_epoch: int, model_to_save: nn.Module, training_path: Path):
+def save_model(name: str, cur_epoch: int, model_to_save: nn.Module, training_path: Path, trainable_only=False):
     """
     Save the weights of the model during training
     :param name: name of the file
     :param cur_epoch: current epoch
     :param model_to_save: pytorch model to be saved
     :param training_path: path associated with the training run
+    :param trainable_only: only save the parameters that require grad (and the buffers) together with a reference to
+        the checkpoint the frozen weights were loaded from (model_to_save.base_ckpt, see base_checkpoint_record), which
+        load_ckpt loads first. The full weights are saved if the model was not loaded from a checkpoint
     """
     models_path = training_path
     models_path.mkdir(exist_ok=True, parents=True)
+    save_path = str(models_path / f'{name}.pt')
+    base_ckpt = getattr(model_to_save, 'base_ckpt', None) if trainable_only else None
+    if base_ckpt is None or os.path.abspath(base_ckpt['model_path']) == os.path.abspath(save_path):
+        # no base to load the frozen weights from, or the file would reference itself, keep the full weights
+        trainable_only, base_ckpt = False, None
     torch.save({
         'epoch': cur_epoch,
-        "state_dict": model_to_save.state_dict(),
-    }, str(models_path / f'{name}.pt'))
+        "state_dict": trainable_state_dict(model_to_save) if trainable_only else model_to_save.state_dict(),
+        'base_ckpt': base_ckpt,
+    }, save_path)
     print("save model successfully")
 
 
+def trainable_state_dict(model: nn.Module):
+    """
+    State dict of the model restricted to the parameters that require grad and to the buffers
+    """
+    params = dict(model.named_parameters(remove_duplicate=False))
+    return {k: v for k, v in model.state_dict().items() if k not in params or params[k].requires_grad}
+
+
+def base_checkpoint_record(model_path, is_origin=False):
+    """
+    Reference to a checkpoint the frozen weights of a trainable-only checkpoint are loaded from (see save_model). The
+    size and mtime of the file are recorded so that a base overwritten afterwards is detected by check_base_checkpoint
+    """
+    stat = os.stat(model_path)
+    return {'model_path': os.path.abspath(model_path), 'is_origin': is_origin,
+            'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def check_base_checkpoint(base_ckpt):
+    """
+    Raise if the base checkpoint of a trainable-only checkpoint is missing or is not the file it was saved against
+    """
+    model_path = base_ckpt['model_path']
+    if not os.path.isfile(model_path):
+        raise RuntimeError(f"base checkpoint {model_path} of the trainable-only checkpoint does not exist")
+    stat = os.stat(model_path)
+    if (stat.st_size, stat.st_mtime_ns) != (base_ckpt['size'], base_ckpt['mtime_ns']):
+        raise RuntimeError(f"base checkpoint {model_path} changed since the trainable-only checkpoint was saved, "
+                           f"its frozen weights would not match")
+
+
+def load_checkpoint(model_path):
+    """
+    Load a checkpoint on the cpu with memory-mapped tensors, load_state_dict then copies them straight into the model
+    instead of materializing the whole file first
+    """
+    try:
+        return torch.load(model_path, map_location='cpu', mmap=True)
+    except RuntimeError:
+        # checkpoints in the legacy (non zip) format can not be memory-mapped
+        return torch.load(model_path, map_location='cpu')
+
+
+def shared_copy(model: nn.Module):
+    """
+    Copy of the model that only duplicates the trainable parameters, the frozen parameters, the buffers and the
+    tensors held as attributes (e.g. the feature banks) are shared with the model
+    """
+    memo = {id(param): param for param in model.parameters() if not param.requires_grad}
+    memo.update({id(buffer): buffer for buffer in model.buffers()})
+    for module in model.modules():
+        for value in vars(module).values():
+            if isinstance(value, torch.Tensor):
+                memo[id(value)] = value
+    return copy.deepcopy(model, memo)
+
+
+class AsyncValidator:
+    """
+    Run the validation of a model in a background thread so that the training loop does not wait for it. Validation
+    runs validate_fn(val_model, epoch) on a copy of the model (see shared_copy) whose trainable parameters are set to
+    the ones of the model when the epoch is submitted, so its metrics and the saved weights belong to that epoch
+
+    Example:
+    ```
+    validator = AsyncValidator(model, validate)
+    for epoch in range(num_epochs):
+        train_one_epoch(model)
+        validator.submit(model, epoch)
+    validator.close()
+    ```
+    """
+
+    def __init__(self, model: nn.Module, validate_fn):
+        self.val_model = shared_copy(model)
+        self.val_params = dict(self.val_model.named_parameters())
+        self.validate_fn = validate_fn
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+    def submit(self, model: nn.Module, epoch: int):
+        """
+        Snapshot the trainable parameters of the model and validate them in the background, waits for the previous
+        validation if it is still running
+        """
+        self.wait()
+        with torch.no_grad():
+            for name, param in model.named_parameters():
+                if param.requires_grad:
+                    self.val_params[name].copy_(param)
+        if self.stream is not None:
+            self.stream.wait_stream(torch.cuda.current_stream())
+        self.future = self.executor.submit(self._validate, epoch)
+
+    def _validate(self, epoch):
+        if self.stream is None:
+            return self.validate_fn(self.val_model, epoch)
+        with torch.cuda.stream(self.stream):
+            return self.validate_fn(self.val_model, epoch)
+
+    def wait(self):
+        """
+        Wait for the running validation, errors raised by validate_fn are raised here
+        """
+        if self.future is not None:
+            future, self.future = self.future, None
+            return future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
 class RunningAverage():
     """A simple class that maintains the running average of a quantity
 